@@ -1,8 +1,12 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
-from .configuration import *
-from .guarantee import *
+from .configuration import Configuration, ConfigurationCompany
+from .guarantee import (GuaranteeType, Product, Guarantee, GuaranteeQueue,
+    GuaranteeSaleLine, GuaranteeInvoiceLine, Sale, SaleLine, InvoiceLine,
+    CreateGuarantees, ImportGuaranteesStart, ImportGuaranteesResult,
+    ImportGuarantees, UpdateEndDatesResult, UpdateEndDates)
+from .statistics import GuaranteeStatistics, GuaranteeStatisticsCache
 
 
 def register():
@@ -12,8 +16,20 @@ def register():
         GuaranteeType,
         Product,
         Guarantee,
+        GuaranteeQueue,
         GuaranteeSaleLine,
         GuaranteeInvoiceLine,
+        Sale,
         SaleLine,
         InvoiceLine,
+        ImportGuaranteesStart,
+        ImportGuaranteesResult,
+        UpdateEndDatesResult,
+        GuaranteeStatistics,
+        GuaranteeStatisticsCache,
         module='guarantee', type_='model')
+    Pool.register(
+        CreateGuarantees,
+        ImportGuarantees,
+        UpdateEndDates,
+        module='guarantee', type_='wizard')
@@ -1,9 +1,14 @@
 # The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from sql import Column
+
+from trytond.cache import Cache
 from trytond.model import Model, ModelSingleton, ModelSQL, ModelView, fields
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 
+from .profiling import record_cache_hit
+
 __all__ = ['Configuration', 'ConfigurationCompany']
 
 
@@ -16,27 +21,108 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
             domain=[
                 ('code', '=', 'guarantee.guarantee'),
                 ]), 'get_company_config', 'set_company_config')
+    guarantee_chunk_size = fields.Integer('Guarantee Chunk Size',
+        help='The number of records processed at once by the bulk '
+        'operations and the scheduled tasks on guarantees')
+    group_guarantees = fields.Function(fields.Boolean('Group Guarantees',
+            help='If marked sale lines sharing party, product, guarantee '
+            'type and start date will share the same guarantee'),
+        'get_company_config', 'set_company_config')
+    find_guarantee = fields.Function(fields.Boolean('Find Guarantee',
+            help='If marked the guarantee of the party that applies for the '
+            'product is set on sale and invoice lines when the product '
+            'changes'),
+        'get_company_config', 'set_company_config')
+    guarantee_creation = fields.Function(fields.Selection([
+                ('manual', 'Manual'),
+                ('process', 'On Sale Process'),
+                ('queue', 'Queued on Sale Process'),
+                ], 'Guarantee Creation',
+            help='Manual: guarantees are created from the sale wizard.\n'
+            'On Sale Process: guarantees are created when the sale is '
+            'processed.\n'
+            'Queued on Sale Process: sale lines are queued when the sale is '
+            'processed and their guarantees are created by a scheduled '
+            'task.'),
+        'get_company_config', 'set_company_config')
+    expiring_days = fields.Integer('Expiring Days',
+        help='The number of days before its end date from which an active '
+        'guarantee is counted as expiring in the statistics')
+    statistics_materialized = fields.Boolean('Materialize Statistics',
+        help='If marked the guarantee statistics are stored and refreshed '
+        'daily instead of being computed on each read')
+    statistics_date = fields.Date('Statistics Date', readonly=True)
+    statistics_timestamp = fields.DateTime('Statistics Timestamp',
+        readonly=True)
+    expired_date = fields.Date('Expired Date', readonly=True,
+        help='The guarantees ending until this date have already been '
+        'processed by the expiry task')
+    archive_months = fields.Integer('Archive After Months',
+        help='The number of months after their end date from which the '
+        'guarantees are archived. Leave empty to never archive them')
 
     @classmethod
-    def get_company_config(self, configs, names):
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for configs, values in zip(actions, actions):
+            if ('statistics_materialized' in values
+                    and not values['statistics_materialized']):
+                # The stored groups are no longer marked when guarantees
+                # change so the next refresh must recompute all of them
+                values = values.copy()
+                values['statistics_date'] = None
+            args.extend((configs, values))
+        super(Configuration, cls).write(*args)
+
+    @classmethod
+    def _get_companies_values(cls):
+        '''Return a dictionary with the configuration values of each company
+
+        The values of all the companies are loaded with a single query and
+        kept in cache until a company configuration is modified.
+        '''
         pool = Pool()
         CompanyConfig = pool.get('guarantee.configuration.company')
+        cursor = Transaction().cursor
+        table = CompanyConfig.__table__()
+
+        companies_values = CompanyConfig._values_cache.get(None)
+        if companies_values is not None:
+            record_cache_hit()
+            return companies_values
+
+        fnames = ['id', 'company'] + [n for n, f in cls._fields.iteritems()
+            if getattr(f, 'getter', None) == 'get_company_config']
+        cursor.execute(*table.select(*[Column(table, f) for f in fnames],
+                order_by=[table.id.desc]))
+        companies_values = {}
+        for row in cursor.fetchall():
+            values = dict(zip(fnames, row))
+            companies_values[values['company']] = values
+        CompanyConfig._values_cache.set(None, companies_values)
+        return companies_values
+
+    @classmethod
+    def _get_company_values(cls, company_id):
+        'Return a dictionary with the configuration values of the company'
+        return cls._get_companies_values().get(company_id, {})
 
+    @staticmethod
+    def default_guarantee_creation():
+        return 'manual'
+
+    @classmethod
+    def get_company_config(self, configs, names):
         company_id = Transaction().context.get('company')
-        company_configs = CompanyConfig.search([
-                ('company', '=', company_id),
-                ])
+        values = self._get_company_values(company_id)
 
         res = {}
         for fname in names:
-            res[fname] = {
-                configs[0].id: None,
-                }
-            if company_configs:
-                val = getattr(company_configs[0], fname)
-                if isinstance(val, Model):
-                    val = val.id
-                res[fname][configs[0].id] = val
+            val = values.get(fname)
+            if isinstance(val, Model):
+                val = val.id
+            res[fname] = dict((c.id, val) for c in configs)
         return res
 
     @classmethod
@@ -45,11 +131,9 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
         CompanyConfig = pool.get('guarantee.configuration.company')
 
         company_id = Transaction().context.get('company')
-        company_configs = CompanyConfig.search([
-                ('company', '=', company_id),
-                ])
-        if company_configs:
-            company_config = company_configs[0]
+        values = self._get_company_values(company_id)
+        if values:
+            company_config = CompanyConfig(values['id'])
         else:
             company_config = CompanyConfig(company=company_id)
         setattr(company_config, name, value)
@@ -66,3 +150,27 @@ class ConfigurationCompany(ModelSQL):
         domain=[
             ('code', '=', 'guarantee.guarantee'),
             ])
+    group_guarantees = fields.Boolean('Group Guarantees')
+    find_guarantee = fields.Boolean('Find Guarantee')
+    guarantee_creation = fields.Selection([
+            ('manual', 'Manual'),
+            ('process', 'On Sale Process'),
+            ('queue', 'Queued on Sale Process'),
+            ], 'Guarantee Creation')
+    _values_cache = Cache('guarantee_configuration_company.values',
+        context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._values_cache.clear()
+        return super(ConfigurationCompany, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(ConfigurationCompany, cls).write(*args)
+        cls._values_cache.clear()
+
+    @classmethod
+    def delete(cls, company_configs):
+        super(ConfigurationCompany, cls).delete(company_configs)
+        cls._values_cache.clear()
@@ -1,14 +1,54 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime
+import json
+import logging
+from decimal import Decimal
+from StringIO import StringIO
 from dateutil.relativedelta import relativedelta
+from sql import Cast, Literal, Null, Union
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp, Substring
+from trytond.cache import Cache, LRUDict
+from trytond.exceptions import UserError
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateTransition, StateView, Button
 from trytond import backend
 
+from .profiling import profiled, record_cache_hit
+
 __all__ = ['GuaranteeType', 'Product', 'GuaranteeSaleLine',
-    'GuaranteeInvoiceLine', 'Guarantee', 'SaleLine', 'InvoiceLine']
+    'GuaranteeInvoiceLine', 'Guarantee', 'GuaranteeQueue', 'Sale',
+    'SaleLine', 'InvoiceLine',
+    'CreateGuarantees', 'ImportGuaranteesStart', 'ImportGuaranteesResult',
+    'ImportGuarantees', 'UpdateEndDatesResult', 'UpdateEndDates']
+
+DEFAULT_CHUNK_SIZE = 500
+CACHE_SIZE_LIMIT = 10240
+GUARANTEE_SALE_STATES = ['confirmed', 'processing', 'done']
+
+logger = logging.getLogger(__name__)
+
+
+def transaction_cache(name):
+    '''Returns the cache dictionary called name of the current transaction
+
+    The caches are kept on the cursor so they are never shared with other
+    transactions and they are dropped with it.
+    '''
+    cursor = Transaction().cursor
+    caches = getattr(cursor, 'guarantee_caches', None)
+    if caches is None:
+        caches = cursor.guarantee_caches = {}
+    if name not in caches:
+        caches[name] = LRUDict(CACHE_SIZE_LIMIT)
+    return caches[name]
 
 
 class GuaranteeType(ModelSQL, ModelView):
@@ -24,6 +64,8 @@ class GuaranteeType(ModelSQL, ModelView):
     includes_consumables = fields.Boolean('Include Consumables', help='If '
         'marked this waranty type will include consumable products')
     active = fields.Boolean('Active')
+    _applies_cache = Cache('guarantee_type.applies_for_product_type',
+        context=False)
 
     @staticmethod
     def default_duration():
@@ -33,15 +75,94 @@ class GuaranteeType(ModelSQL, ModelView):
     def default_active():
         return True
 
+    @classmethod
+    def write(cls, *args):
+        SaleLine = Pool().get('sale.line')
+        super(GuaranteeType, cls).write(*args)
+        cls._applies_cache.clear()
+        SaleLine._line_in_guarantee_cache().clear()
+
+    @classmethod
+    def delete(cls, types):
+        SaleLine = Pool().get('sale.line')
+        super(GuaranteeType, cls).delete(types)
+        cls._applies_cache.clear()
+        SaleLine._line_in_guarantee_cache().clear()
+
     def applies_for_product(self, product):
-        if product.type == 'service':
-            return self.includes_services
-        elif product.type == 'goods':
-            if product.consumable:
-                return self.includes_consumables
-            return self.includes_goods
+        return self.applies_for_product_type(product.type, product.consumable)
+
+    def applies_for_products(self, products):
+        'Returns a dictionary with the result of applies_for_product by id'
+        return dict((p.id, self.applies_for_product(p)) for p in products)
+
+    def applies_for_product_type(self, product_type, consumable):
+        'Returns if the type applies for products of this type and consumable'
+        key = (self.id, product_type, bool(consumable))
+        if self.id is not None and self.id >= 0:
+            result = self._applies_cache.get(key)
+            if result is not None:
+                record_cache_hit()
+                return result
+        if product_type == 'service':
+            result = bool(self.includes_services)
+        elif product_type == 'goods':
+            if consumable:
+                result = bool(self.includes_consumables)
+            else:
+                result = bool(self.includes_goods)
         else:
-            return False
+            result = False
+        if self.id is not None and self.id >= 0:
+            self._applies_cache.set(key, result)
+        return result
+
+    def get_end_date(self, start_date):
+        'Returns the end date of a guarantee starting on start_date'
+        return start_date + relativedelta(months=self.duration)
+
+    @classmethod
+    def update_end_dates(cls, types):
+        '''Recompute the end date of the guarantees of the types from their
+        duration and returns the number of guarantees changed
+
+        Guarantees are updated with one query per type and chunk of distinct
+        start dates.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Guarantee = pool.get('guarantee.guarantee')
+        StatisticsCache = pool.get('guarantee.statistics.cache')
+        cursor = Transaction().cursor
+        table = Guarantee.__table__()
+        today = Date.today()
+
+        count = 0
+        for type_ in types:
+            cursor.execute(*table.select(table.start_date,
+                    where=table.type == type_.id,
+                    group_by=table.start_date))
+            start_dates = [r[0] for r in cursor.fetchall()]
+            for sub_dates in grouped_slice(start_dates):
+                sub_dates = list(sub_dates)
+                end_date = Case(*[(table.start_date == d,
+                            type_.get_end_date(d)) for d in sub_dates])
+                where = ((table.type == type_.id)
+                    & table.start_date.in_(sub_dates))
+                cursor.execute(*table.select(table.id,
+                        where=where & (table.end_date != end_date)))
+                StatisticsCache.mark_dirty([r[0] for r in cursor.fetchall()])
+                cursor.execute(*table.update(
+                        columns=[table.end_date, table.write_date],
+                        values=[end_date, CurrentTimestamp()],
+                        where=where & (table.end_date != end_date)))
+                count += cursor.rowcount
+                cursor.execute(*table.update(
+                        columns=[table.state],
+                        values=[Guarantee._state_column(table, today)],
+                        where=where))
+        Guarantee.clear_cache()
+        return count
 
 
 class Product:
@@ -49,6 +170,26 @@ class Product:
     __metaclass__ = PoolMeta
 
     guarantee_type = fields.Many2One('guarantee.type', 'Guarante Type')
+    guarantees = fields.One2Many('guarantee.guarantee', 'product',
+        'Guarantees', readonly=True)
+    guarantee_count = fields.Function(fields.Integer('Guarantees'),
+        'get_guarantee_count')
+
+    @classmethod
+    def get_guarantee_count(cls, products, name):
+        pool = Pool()
+        Guarantee = pool.get('guarantee.guarantee')
+        cursor = Transaction().cursor
+        guarantee = Guarantee.__table__()
+
+        result = dict((p.id, 0) for p in products)
+        for sub_ids in grouped_slice([p.id for p in products]):
+            cursor.execute(*guarantee.select(guarantee.product,
+                    Count(guarantee.id),
+                    where=reduce_ids(guarantee.product, sub_ids),
+                    group_by=guarantee.product))
+            result.update(dict(cursor.fetchall()))
+        return result
 
 
 class GuaranteeSaleLine(ModelSQL):
@@ -78,11 +219,18 @@ class Guarantee(ModelSQL, ModelView):
     party = fields.Many2One('party.party', 'Party', required=True)
     document = fields.Reference('Document', selection='get_origin',
         required=True, select=True)
+    product = fields.Many2One('product.product', 'Product', readonly=True,
+        select=True)
     type = fields.Many2One('guarantee.type', 'Type', required=True)
     start_date = fields.Date('Start Date', required=True)
-    end_date = fields.Date('End Date', required=True)
+    end_date = fields.Date('End Date', required=True, select=True)
     in_guarantee = fields.Function(fields.Boolean('In Guarantee'),
-        'get_in_guarantee')
+        'get_in_guarantee', searcher='search_in_guarantee')
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('active', 'Active'),
+            ('expired', 'Expired'),
+            ], 'State', readonly=True, select=True)
     sale_lines = fields.Many2Many('guarantee.guarantee-sale.line', 'guarantee',
         'sale_line', 'Sale Lines')
     invoice_lines = fields.Many2Many(
@@ -92,7 +240,20 @@ class Guarantee(ModelSQL, ModelView):
         'Sale Lines in Guarantee')
     guarantee_invoice_lines = fields.One2Many('account.invoice.line',
         'guarantee', 'Invoice Lines in Guarantee')
+    claim_count = fields.Function(fields.Integer('Claims',
+            help='The number of sale and invoice lines that refer to the '
+            'guarantee, without the invoice lines of those sale lines'),
+        'get_claims', searcher='search_claim_count')
+    last_claim_date = fields.Function(fields.Date('Last Claim Date'),
+        'get_claims')
+    claim_value = fields.Function(fields.Numeric('Claims Value',
+            digits=(16, 4), help='The list price value of the lines in '
+            'guarantee with zero unit price'), 'get_claims')
     notes = fields.Text('Notes')
+    active = fields.Boolean('Active', select=True,
+        help='Unmarked when the guarantee is archived')
+    _get_origin_cache = Cache('guarantee_guarantee.get_origin',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -106,11 +267,35 @@ class Guarantee(ModelSQL, ModelView):
     def __register__(cls, module_name):
         TableHandler = backend.get('TableHandler')
         table = TableHandler(cls, module_name)
+        product_exist = table.column_exist('product')
 
         super(Guarantee, cls).__register__(module_name)
 
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+
+        # Migration from 3.4: fill product from document
+        if not product_exist:
+            prefix = 'product.product,'
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.product],
+                    values=[Cast(Substring(sql_table.document,
+                                len(prefix) + 1), 'INTEGER')],
+                    where=sql_table.document.like(prefix + '%')))
+
         # Migration from 3.4: drop required on state
         table.not_null_action('state', action='remove')
+        # and compute it from the dates
+        cursor.execute(*sql_table.update(
+                columns=[sql_table.state],
+                values=[cls._state_column(sql_table, datetime.date.today())],
+                where=((sql_table.state == Null)
+                    | ~sql_table.state.in_(['pending', 'active', 'expired']))))
+
+        table.index_action(['party', 'start_date', 'end_date'], 'add')
+        table.index_action(['product', 'party', 'end_date'], 'add')
+
+        cls._get_origin_cache.clear()
 
     @classmethod
     def _get_origin(cls):
@@ -120,22 +305,210 @@ class Guarantee(ModelSQL, ModelView):
     @classmethod
     def get_origin(cls):
         Model = Pool().get('ir.model')
+        language = Transaction().language
+        origins = cls._get_origin_cache.get(language)
+        if origins is not None:
+            record_cache_hit()
+            return origins
         models = cls._get_origin()
         models = Model.search([
                 ('model', 'in', models),
                 ])
-        return [(m.model, m.name) for m in models]
+        origins = [(m.model, m.name) for m in models]
+        cls._get_origin_cache.set(language, origins)
+        return origins
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_active():
+        return True
+
+    @staticmethod
+    def _get_state(start_date, end_date, date):
+        'Returns the state of a guarantee on date'
+        if start_date > date:
+            return 'pending'
+        elif end_date < date:
+            return 'expired'
+        return 'active'
 
-    def get_in_guarantee(self, name):
+    @staticmethod
+    def _state_column(table, date):
+        'Returns the SQL expression of the state of a guarantee on date'
+        return Case((table.start_date > date, 'pending'),
+            (table.end_date < date, 'expired'),
+            else_='active')
+
+    @staticmethod
+    def _get_document_product(document):
+        'Returns the id of the product of document if it is one'
+        if hasattr(document, 'id'):
+            document = (document.__name__, document.id)
+        elif isinstance(document, basestring):
+            document = document.split(',')
+        if document and document[0] == 'product.product':
+            try:
+                return int(document[1])
+            except (IndexError, ValueError):
+                pass
+
+    @staticmethod
+    def _values_cache():
+        'Returns the cache of the values of the guarantees'
+        return transaction_cache('guarantee_guarantee.values')
+
+    @staticmethod
+    def _get_guarantee_date():
+        'Return the date used to compute if guarantees are in guarantee'
         pool = Pool()
         Date = pool.get('ir.date')
-        date = Transaction().context.get('gurantee_date', Date.today())
-        return self.applies_for_date(date)
+        return Transaction().context.get('gurantee_date') or Date.today()
+
+    @classmethod
+    @profiled
+    def get_in_guarantee(cls, guarantees, name):
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        date = cls._get_guarantee_date()
+
+        result = dict((g.id, False) for g in guarantees)
+        for sub_ids in grouped_slice([g.id for g in guarantees]):
+            cursor.execute(*table.select(table.id,
+                    where=(reduce_ids(table.id, sub_ids)
+                        & (table.start_date <= date)
+                        & (table.end_date >= date))))
+            result.update(dict((r[0], True) for r in cursor.fetchall()))
+        return result
+
+    @classmethod
+    def search_in_guarantee(cls, name, clause):
+        date = cls._get_guarantee_date()
+        _, operator, value = clause
+        if operator in ('in', 'not in'):
+            values = set(bool(v) for v in value)
+            if operator == 'not in':
+                values = set([True, False]) - values
+            if len(values) == 2:
+                return []
+            elif not values:
+                return [('id', '=', None)]
+            operator, value = '=', values.pop()
+        elif operator not in ('=', '!='):
+            raise ValueError('Unsupported operator "%s" for in_guarantee'
+                % operator)
+        if (operator == '=') != bool(value):
+            return ['OR',
+                ('start_date', '>', date),
+                ('end_date', '<', date),
+                ]
+        return [
+            ('start_date', '<=', date),
+            ('end_date', '>=', date),
+            ]
+
+    @classmethod
+    def _claims_query(cls, guarantee_ids=None):
+        '''Returns the query of the claims of guarantee_ids or all guarantees
+
+        The claims are the sale lines that refer to the guarantee and the
+        invoice lines that refer to it and do not come from a sale line.
+        '''
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        sale_line = SaleLine.__table__()
+        sale = Sale.__table__()
+        invoice_line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+
+        queries = []
+        for line, document, date, condition in [
+                (sale_line, sale, sale.sale_date,
+                    sale_line.sale == sale.id),
+                (invoice_line, invoice, invoice.invoice_date,
+                    invoice_line.invoice == invoice.id),
+                ]:
+            if guarantee_ids is not None:
+                where = reduce_ids(line.guarantee, guarantee_ids)
+            else:
+                where = line.guarantee != Null
+            if line is invoice_line:
+                where &= ((line.origin == Null)
+                    | ~line.origin.like('sale.line,%'))
+            queries.append(line.join(document, 'LEFT', condition=condition
+                    ).select(line.guarantee.as_('guarantee'),
+                    date.as_('date'),
+                    line.product.as_('product'),
+                    Case((line.unit_price == 0, line.quantity),
+                        else_=0).as_('quantity'),
+                    where=where))
+        return Union(*queries, all_=True)
+
+    @classmethod
+    @profiled
+    def get_claims(cls, guarantees, names):
+        pool = Pool()
+        Product = pool.get('product.product')
+        cursor = Transaction().cursor
+
+        result = {}
+        for name, default in [
+                ('claim_count', 0),
+                ('last_claim_date', None),
+                ('claim_value', Decimal(0)),
+                ]:
+            if name in names:
+                result[name] = dict((g.id, default) for g in guarantees)
+
+        quantities = []
+        for sub_ids in grouped_slice([g.id for g in guarantees]):
+            claims = cls._claims_query(list(sub_ids))
+            cursor.execute(*claims.select(claims.guarantee, claims.product,
+                    Count(Literal('*')), Max(claims.date),
+                    Sum(claims.quantity),
+                    group_by=[claims.guarantee, claims.product]))
+            for guarantee_id, product_id, count, date, quantity in (
+                    cursor.fetchall()):
+                if 'claim_count' in result:
+                    result['claim_count'][guarantee_id] += count
+                if 'last_claim_date' in result and date:
+                    last_date = result['last_claim_date'][guarantee_id]
+                    if not last_date or date > last_date:
+                        result['last_claim_date'][guarantee_id] = date
+                if product_id and quantity:
+                    quantities.append((guarantee_id, product_id, quantity))
+
+        if 'claim_value' in result and quantities:
+            products = Product.browse(list(set(q[1] for q in quantities)))
+            prices = dict((p.id, p.list_price or Decimal(0))
+                for p in products)
+            for guarantee_id, product_id, quantity in quantities:
+                result['claim_value'][guarantee_id] += (
+                    Decimal(str(quantity)) * prices[product_id])
+        return result
+
+    @classmethod
+    def search_claim_count(cls, name, clause):
+        table = cls.__table__()
+        claims = cls._claims_query()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        query = table.join(claims, 'LEFT',
+            condition=claims.guarantee == table.id
+            ).select(table.id,
+            group_by=table.id,
+            having=Operator(Count(claims.guarantee), value))
+        return [('id', 'in', query)]
 
     @fields.depends('type', 'start_date')
     def on_change_with_end_date(self):
         if self.type and self.start_date:
-            return self.start_date + relativedelta(months=self.type.duration)
+            return self.type.get_end_date(self.start_date)
 
     def applies_for_date(self, date):
         'Returns if the guarantee applies for the current date'
@@ -145,27 +518,849 @@ class Guarantee(ModelSQL, ModelView):
         '''Returns if the current waranty applies for the current product
         and date
         '''
+        GuaranteeType = Pool().get('guarantee.type')
+        loaded = self._values or {}
+        if (self.id is not None and self.id >= 0
+                and not all(f in loaded
+                    for f in ('start_date', 'end_date', 'type'))):
+            values = self.get_cached_values([self.id]).get(self.id)
+            if values:
+                start_date, end_date, type_id = values
+                if not (start_date <= date <= end_date):
+                    return False
+                return GuaranteeType(type_id).applies_for_product(product)
         if not self.applies_for_date(date):
             return False
         return self.type.applies_for_product(product)
 
+    @classmethod
+    def get_cached_values(cls, ids):
+        '''Returns a dictionary with the start date, end date and type id of
+        each guarantee id
+
+        The values are read once and kept in a bounded cache of the
+        transaction until a guarantee is modified.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cache = cls._values_cache()
+
+        result = {}
+        missing = []
+        for id_ in ids:
+            values = cache.get(id_)
+            if values is not None:
+                record_cache_hit()
+                result[id_] = values
+            else:
+                missing.append(id_)
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*table.select(table.id, table.start_date,
+                    table.end_date, table.type,
+                    where=reduce_ids(table.id, sub_ids)))
+            for id_, start_date, end_date, type_id in cursor.fetchall():
+                values = (start_date, end_date, type_id)
+                cache[id_] = values
+                result[id_] = values
+        return result
+
+    @classmethod
+    def clear_cache(cls):
+        'Clear the cached values of the guarantees and of the lines'
+        SaleLine = Pool().get('sale.line')
+        cls._values_cache().clear()
+        SaleLine._line_in_guarantee_cache().clear()
+
+    @classmethod
+    def _rollback_savepoint(cls, name):
+        '''Rollback to the savepoint name and clear the caches of the
+        transaction filled since it'''
+        cursor = Transaction().cursor
+        cursor.execute('ROLLBACK TO SAVEPOINT %s' % name)
+        cursor.cache.clear()
+        cls.clear_cache()
+
+    @classmethod
+    @profiled
+    def find_applicable(cls, keys):
+        '''Returns a dictionary with the guarantee that applies for each
+        (party, product, date) tuple of keys or None if there is none
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        today = Date.today()
+
+        result = dict((k, None) for k in keys)
+        keys = [k for k in keys if k[0] and k[1]]
+        if not keys:
+            return result
+        dates = [d or today for _, _, d in keys]
+        guarantees = cls.search([
+                ('party', 'in', list(set(p.id for p, _, _ in keys))),
+                ('product', 'in', list(set(p.id for _, p, _ in keys))),
+                ('start_date', '<=', max(dates)),
+                ('end_date', '>=', min(dates)),
+                ], order=[('start_date', 'DESC'), ('id', 'DESC')])
+        # Read the values of all the candidates at once
+        cls.get_cached_values([g.id for g in guarantees])
+        candidates = {}
+        for guarantee in guarantees:
+            candidates.setdefault((guarantee.party.id, guarantee.product.id),
+                []).append(guarantee)
+        for key in keys:
+            party, product, date = key
+            for guarantee in candidates.get((party.id, product.id), []):
+                if guarantee.applies_for_product(product, date or today):
+                    result[key] = guarantee
+                    break
+        return result
+
+    @classmethod
+    def _lines_in_guarantee(cls, from_, line, date, where):
+        '''Returns the ids of the lines of from_ that are in guarantee
+
+        from_ must join line with the table holding date, which is the date
+        used to check the guarantee (today if it is empty).
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        GuaranteeType = pool.get('guarantee.type')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        cursor = Transaction().cursor
+        guarantee = cls.__table__()
+        type_ = GuaranteeType.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        cursor.execute(*from_.join(guarantee,
+                condition=line.guarantee == guarantee.id
+                ).join(type_, condition=guarantee.type == type_.id
+                ).join(product, condition=line.product == product.id
+                ).join(template, condition=product.template == template.id
+                ).select(line.id, date,
+                guarantee.start_date, guarantee.end_date, type_.id,
+                type_.includes_services, type_.includes_goods,
+                type_.includes_consumables, template.type,
+                template.consumable,
+                where=where))
+        today = Date.today()
+        line_ids = set()
+        for (line_id, date, start_date, end_date, type_id, services, goods,
+                consumables, product_type, consumable) in cursor.fetchall():
+            date = date or today
+            if not (start_date <= date <= end_date):
+                continue
+            guarantee_type = GuaranteeType(type_id,
+                includes_services=services, includes_goods=goods,
+                includes_consumables=consumables)
+            if guarantee_type.applies_for_product_type(product_type,
+                    consumable):
+                line_ids.add(line_id)
+        return line_ids
+
     @classmethod
     def create(cls, vlist):
         pool = Pool()
-        Sequence = pool.get('ir.sequence')
         Config = pool.get('guarantee.configuration')
+        Date = pool.get('ir.date')
 
         sequence = Config(1).guarantee_sequence
         if not sequence:
             cls.raise_user_error('no_guarantee_sequence')
         vlist = [x.copy() for x in vlist]
+        to_code = [v for v in vlist if 'code' not in v]
+        if to_code:
+            codes = cls._new_codes(sequence, len(to_code))
+            for vals, code in zip(to_code, codes):
+                vals['code'] = code
+        today = Date.today()
         for vals in vlist:
-            if 'code' not in vals:
-                vals['code'] = Sequence.get_id(sequence.id)
+            if vals.get('start_date') and vals.get('end_date'):
+                vals['state'] = cls._get_state(vals['start_date'],
+                    vals['end_date'], today)
+            if 'document' in vals:
+                vals['product'] = cls._get_document_product(vals['document'])
         return super(Guarantee, cls).create(vlist)
 
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        to_update = []
+        regrouped = []
+        for guarantees, values in zip(actions, actions):
+            if 'document' in values:
+                values = values.copy()
+                values['product'] = cls._get_document_product(
+                    values['document'])
+            if 'start_date' in values or 'end_date' in values:
+                to_update.extend(guarantees)
+            if set(values) & set(['type', 'party', 'end_date']):
+                regrouped.extend(guarantees)
+            args.extend((guarantees, values))
+        if regrouped:
+            StatisticsCache = Pool().get('guarantee.statistics.cache')
+            StatisticsCache.mark_dirty([g.id for g in regrouped])
+        super(Guarantee, cls).write(*args)
+        cls.clear_cache()
+        if to_update:
+            cls.update_state(to_update)
+
+    @classmethod
+    def delete(cls, guarantees):
+        StatisticsCache = Pool().get('guarantee.statistics.cache')
+        StatisticsCache.mark_dirty([g.id for g in guarantees])
+        super(Guarantee, cls).delete(guarantees)
+        cls.clear_cache()
+
+    @classmethod
+    def update_state(cls, guarantees):
+        'Compute the state of the guarantees from their dates'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        today = Date.today()
+        for sub_ids in grouped_slice([g.id for g in guarantees]):
+            cursor.execute(*table.update(
+                    columns=[table.state],
+                    values=[cls._state_column(table, today)],
+                    where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def process_expired(cls):
+        '''Update the state of the guarantees whose start or end date has
+        been crossed since the last run
+
+        Pending guarantees that have started are activated with a single
+        query. The guarantees ending after the expired date of the
+        configuration and before today are read through the end date index
+        by chunks and passed to expire, committing after each chunk. The
+        expired date is then moved to yesterday. The guarantees created or
+        written with a past end date are expired when they are saved.
+        '''
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        Date = pool.get('ir.date')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+
+        config = Config(1)
+        chunk_size = config.guarantee_chunk_size or DEFAULT_CHUNK_SIZE
+        today = Date.today()
+        cursor.execute(*table.update(
+                columns=[table.state, table.write_uid, table.write_date],
+                values=['active', transaction.user, CurrentTimestamp()],
+                where=((table.state == 'pending')
+                    & (table.start_date <= today)
+                    & (table.end_date >= today))))
+        cursor.commit()
+
+        where = (table.end_date < today) & (table.state != 'expired')
+        if config.expired_date:
+            where &= table.end_date > config.expired_date
+        last_date, last_id = None, None
+        while True:
+            chunk_where = where
+            if last_date:
+                chunk_where &= ((table.end_date > last_date)
+                    | ((table.end_date == last_date) & (table.id > last_id)))
+            cursor.execute(*table.select(table.id, table.end_date,
+                    where=chunk_where,
+                    order_by=[table.end_date.asc, table.id.asc],
+                    limit=chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id, last_date = rows[-1]
+            cls.expire(cls.browse([r[0] for r in rows]))
+            cursor.commit()
+        Config.write([config], {
+                'expired_date': today - datetime.timedelta(days=1),
+                })
+        cursor.commit()
+
+    @classmethod
+    def archive_expired(cls):
+        '''Archive the guarantees that ended more months ago than the
+        archive months of the configuration
+
+        Guarantees are archived by chunks and the transaction is committed
+        after each one.
+        '''
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        Date = pool.get('ir.date')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+
+        config = Config(1)
+        if not config.archive_months:
+            return
+        chunk_size = config.guarantee_chunk_size or DEFAULT_CHUNK_SIZE
+        limit_date = Date.today() - relativedelta(months=config.archive_months)
+        while True:
+            cursor.execute(*table.select(table.id,
+                    where=((table.active == True)
+                        & (table.end_date < limit_date)),
+                    limit=chunk_size))
+            ids = [r[0] for r in cursor.fetchall()]
+            if not ids:
+                break
+            cursor.execute(*table.update(
+                    columns=[table.active, table.write_uid, table.write_date],
+                    values=[False, transaction.user, CurrentTimestamp()],
+                    where=reduce_ids(table.id, ids)))
+            cursor.commit()
+        cls.clear_cache()
+
+    @classmethod
+    def expire(cls, guarantees):
+        '''Mark as expired the guarantees whose end date has passed
+
+        It is called by process_expired and can be extended to notify or
+        close the guarantees.
+        '''
+        cls.write(guarantees, {
+                'state': 'expired',
+                })
+        logger.info('%s guarantees expired', len(guarantees))
+
+    @classmethod
+    def link_invoice_lines(cls, invoice_lines):
+        '''Relate the invoice lines to the guarantees created from their sale
+        line origin'''
+        pool = Pool()
+        GuaranteeSaleLine = pool.get('guarantee.guarantee-sale.line')
+        cursor = Transaction().cursor
+        relation = GuaranteeSaleLine.__table__()
+
+        origins = {}
+        for line in invoice_lines:
+            if line.origin and line.origin.__name__ == 'sale.line':
+                origins.setdefault(line.origin.id, []).append(line.id)
+        values = []
+        for sub_ids in grouped_slice(origins.keys()):
+            cursor.execute(*relation.select(relation.guarantee,
+                    relation.sale_line,
+                    where=reduce_ids(relation.sale_line, sub_ids)))
+            for guarantee_id, sale_line_id in cursor.fetchall():
+                values.extend((guarantee_id, l) for l in origins[sale_line_id])
+        cls._insert_invoice_lines(values)
+
+    @classmethod
+    def _insert_invoice_lines(cls, values):
+        '''Insert the (guarantee id, invoice line id) pairs of values that are
+        not related yet'''
+        pool = Pool()
+        GuaranteeInvoiceLine = pool.get(
+            'guarantee.guarantee-account.invoice.line')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        relation = GuaranteeInvoiceLine.__table__()
+        for sub_values in grouped_slice(list(set(values))):
+            sub_values = list(sub_values)
+            cursor.execute(*relation.select(relation.guarantee,
+                    relation.invoice_line,
+                    where=reduce_ids(relation.invoice_line,
+                        [l for _, l in sub_values])))
+            existing = set(cursor.fetchall())
+            sub_values = [v for v in sub_values if v not in existing]
+            if not sub_values:
+                continue
+            cursor.execute(*relation.insert(
+                    columns=[relation.guarantee, relation.invoice_line,
+                        relation.create_uid, relation.create_date],
+                    values=[[g, l, transaction.user, CurrentTimestamp()]
+                        for g, l in sub_values]))
+
+    @classmethod
+    def backfill_invoice_lines(cls):
+        '''Relate the existing invoice lines to the guarantees created from
+        their sale line origin
+
+        Invoice lines are processed by chunks ordered by id and the
+        transaction is committed after each one.
+        '''
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        GuaranteeSaleLine = pool.get('guarantee.guarantee-sale.line')
+        InvoiceLine = pool.get('account.invoice.line')
+        cursor = Transaction().cursor
+        line = InvoiceLine.__table__()
+        sale_relation = GuaranteeSaleLine.__table__()
+
+        chunk_size = Config(1).guarantee_chunk_size or DEFAULT_CHUNK_SIZE
+        last_id = 0
+        while True:
+            cursor.execute(*line.select(line.id, line.origin,
+                    where=(line.id > last_id)
+                    & line.origin.like('sale.line,%'),
+                    order_by=[line.id.asc], limit=chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            origins = {}
+            for line_id, origin in rows:
+                origins.setdefault(int(origin.split(',')[1]), []).append(
+                    line_id)
+            cursor.execute(*sale_relation.select(sale_relation.guarantee,
+                    sale_relation.sale_line,
+                    where=reduce_ids(sale_relation.sale_line,
+                        origins.keys())))
+            values = []
+            for guarantee_id, sale_line_id in cursor.fetchall():
+                values.extend((guarantee_id, l)
+                    for l in origins[sale_line_id])
+            cls._insert_invoice_lines(values)
+            cursor.commit()
+
+    @classmethod
+    def export_rows(cls, page_size=None):
+        '''Generate a dictionary per guarantee ordered by id
+
+        Guarantees are read by pages of page_size using the id of the last
+        guarantee of each page, so only one page is kept in memory.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        GuaranteeType = pool.get('guarantee.type')
+        GuaranteeSaleLine = pool.get('guarantee.guarantee-sale.line')
+        GuaranteeInvoiceLine = pool.get(
+            'guarantee.guarantee-account.invoice.line')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        party = Party.__table__()
+        type_ = GuaranteeType.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        sale_relation = GuaranteeSaleLine.__table__()
+        invoice_relation = GuaranteeInvoiceLine.__table__()
+
+        if page_size is None:
+            page_size = DEFAULT_CHUNK_SIZE
+        date = cls._get_guarantee_date()
+        in_guarantee = Case(((table.start_date <= date)
+                & (table.end_date >= date), Literal(True)),
+            else_=Literal(False))
+        last_id = 0
+        while True:
+            cursor.execute(*table.join(party,
+                    condition=table.party == party.id
+                    ).join(type_, condition=table.type == type_.id
+                    ).join(product, 'LEFT',
+                    condition=table.product == product.id
+                    ).join(template, 'LEFT',
+                    condition=product.template == template.id
+                    ).select(table.id, table.code, party.name, type_.name,
+                    product.code, template.name, table.start_date,
+                    table.end_date, in_guarantee, table.state,
+                    where=table.id > last_id,
+                    order_by=[table.id.asc], limit=page_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            ids = [r[0] for r in rows]
+            lines = {}
+            for name, relation, column in [
+                    ('sale_lines', sale_relation, sale_relation.sale_line),
+                    ('invoice_lines', invoice_relation,
+                        invoice_relation.invoice_line),
+                    ]:
+                cursor.execute(*relation.select(relation.guarantee, column,
+                        where=reduce_ids(relation.guarantee, ids),
+                        order_by=[column.asc]))
+                for guarantee_id, line_id in cursor.fetchall():
+                    lines.setdefault((name, guarantee_id), []).append(line_id)
+            for (guarantee_id, code, party_name, type_name, product_code,
+                    product_name, start_date, end_date, in_guarantee_,
+                    state) in rows:
+                yield {
+                    'id': guarantee_id,
+                    'code': code,
+                    'party': party_name,
+                    'type': type_name,
+                    'product_code': product_code,
+                    'product_name': product_name,
+                    'start_date': start_date,
+                    'end_date': end_date,
+                    'in_guarantee': bool(in_guarantee_),
+                    'state': state,
+                    'sale_lines': lines.get(('sale_lines', guarantee_id), []),
+                    'invoice_lines': lines.get(
+                        ('invoice_lines', guarantee_id), []),
+                    }
+
+    @classmethod
+    def export(cls, fileobj, format_='csv', page_size=None):
+        'Write all the guarantees into fileobj as CSV or JSON lines'
+        columns = ['id', 'code', 'party', 'type', 'product_code',
+            'product_name', 'start_date', 'end_date', 'in_guarantee', 'state',
+            'sale_lines', 'invoice_lines']
+        if format_ == 'csv':
+            writer = csv.writer(fileobj)
+            writer.writerow(columns)
+        for row in cls.export_rows(page_size=page_size):
+            row['start_date'] = row['start_date'].isoformat()
+            row['end_date'] = row['end_date'].isoformat()
+            if format_ == 'csv':
+                row['sale_lines'] = ' '.join(map(str, row['sale_lines']))
+                row['invoice_lines'] = ' '.join(
+                    map(str, row['invoice_lines']))
+                writer.writerow([unicode(row[c] if row[c] is not None else '')
+                        .encode('utf-8') for c in columns])
+            else:
+                fileobj.write(json.dumps(row) + '\n')
+
+    @classmethod
+    def import_rows(cls, rows, chunk_size=None):
+        '''Create a guarantee for each dictionary of rows
+
+        Each row must contain the party code, the product code and the start
+        date. The type name, end date, code and notes are optional: the type
+        defaults to the guarantee type of the product and the end date is
+        computed from the type duration. Guarantees are created by chunks of
+        chunk_size rows, each one inside a savepoint so a chunk failing with
+        a user or integrity error is rolled back alone and the import
+        continues with the next one. Any other error stops the import.
+
+        Returns the number of guarantees created and a list of (first row,
+        last row, message) for the rows or chunks that could not be
+        imported.
+        '''
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        GuaranteeType = pool.get('guarantee.type')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursor = Transaction().cursor
+        party = Party.__table__()
+        product = Product.__table__()
+        type_ = GuaranteeType.__table__()
+
+        if chunk_size is None:
+            chunk_size = (Config(1).guarantee_chunk_size
+                or DEFAULT_CHUNK_SIZE)
+        cursor.execute(*party.select(party.code, party.id))
+        parties = dict(cursor.fetchall())
+        cursor.execute(*product.select(product.code, product.id,
+                product.guarantee_type))
+        products = dict((r[0], r[1:]) for r in cursor.fetchall())
+        cursor.execute(*type_.select(type_.name, type_.id, type_.duration))
+        types = dict((r[0], r[1:]) for r in cursor.fetchall())
+        durations = dict(types.itervalues())
+
+        def parse_date(value):
+            if isinstance(value, basestring):
+                return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            return value
+
+        created, errors, vlist, numbers = 0, [], [], []
 
-class SaleLine:
+        def create():
+            cursor.execute('SAVEPOINT guarantee_import')
+            try:
+                count = len(cls.create(vlist))
+            except (UserError, DatabaseIntegrityError) as exception:
+                cls._rollback_savepoint('guarantee_import')
+                message = (getattr(exception, 'message', None)
+                    or str(exception))
+                logger.warning('Guarantee import of rows %s to %s failed: %s',
+                    numbers[0], numbers[-1], message)
+                errors.append((numbers[0], numbers[-1], message))
+                return 0
+            cursor.execute('RELEASE SAVEPOINT guarantee_import')
+            return count
+
+        for number, row in enumerate(rows, 1):
+            try:
+                party_id = parties[row['party']]
+            except KeyError:
+                errors.append((number, number, 'Unknown party "%s"'
+                        % row.get('party')))
+                continue
+            try:
+                product_id, type_id = products[row['product']]
+            except KeyError:
+                errors.append((number, number, 'Unknown product "%s"'
+                        % row.get('product')))
+                continue
+            if row.get('type'):
+                if row['type'] not in types:
+                    errors.append((number, number, 'Unknown type "%s"'
+                            % row['type']))
+                    continue
+                type_id = types[row['type']][0]
+            if not type_id:
+                errors.append((number, number, 'Missing type'))
+                continue
+            try:
+                start_date = parse_date(row['start_date'])
+                end_date = parse_date(row.get('end_date'))
+            except (KeyError, ValueError):
+                errors.append((number, number, 'Wrong start or end date'))
+                continue
+            if not end_date:
+                end_date = GuaranteeType(type_id,
+                    duration=durations[type_id]).get_end_date(start_date)
+            vals = {
+                'party': party_id,
+                'document': 'product.product,%s' % product_id,
+                'type': type_id,
+                'start_date': start_date,
+                'end_date': end_date,
+                'notes': row.get('notes'),
+                }
+            if row.get('code'):
+                vals['code'] = row['code']
+            vlist.append(vals)
+            numbers.append(number)
+            if len(vlist) >= chunk_size:
+                created += create()
+                vlist, numbers = [], []
+        if vlist:
+            created += create()
+        return created, errors
+
+    @classmethod
+    def _new_codes(cls, sequence, count):
+        'Return count new codes of sequence'
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+
+        with Transaction().set_user(0):
+            return [Sequence.get_id(sequence.id) for _ in xrange(count)]
+
+
+class GuaranteeQueue(ModelSQL, ModelView):
+    'Guarantee Queue'
+    __name__ = 'guarantee.queue'
+    sale_line = fields.Many2One('sale.line', 'Sale Line', required=True,
+        readonly=True, ondelete='CASCADE')
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(GuaranteeQueue, cls).__setup__()
+        cls._sql_constraints += [
+            ('sale_line_uniq', 'UNIQUE(sale_line)',
+                'A sale line can only be queued once.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(GuaranteeQueue, cls).__register__(module_name)
+
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        # Migration: processed entries are deleted
+        cursor.execute(*table.delete(where=table.state == 'done'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def enqueue(cls, lines):
+        'Queue the lines that are not queued yet'
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+
+        line_ids = set(l.id for l in lines)
+        for sub_ids in grouped_slice(list(line_ids)):
+            cursor.execute(*table.select(table.sale_line,
+                    where=reduce_ids(table.sale_line, sub_ids)))
+            line_ids.difference_update(r[0] for r in cursor.fetchall())
+        for sub_ids in grouped_slice(list(line_ids)):
+            cursor.execute(*table.insert(
+                    columns=[table.sale_line, table.state, table.attempts,
+                        table.create_uid, table.create_date],
+                    values=[[i, 'pending', 0, transaction.user,
+                            CurrentTimestamp()] for i in sub_ids]))
+
+    @classmethod
+    def process_queue(cls, worker=0, workers=1, max_attempts=5):
+        '''Create the guarantees of the pending queued lines
+
+        Lines are processed by chunks and their entries are deleted once
+        their guarantees are created, committing after each chunk. When a
+        chunk fails with a user or integrity error its lines are retried one
+        by one and those failing max_attempts times are marked as failed.
+        Many workers can drain the queue at once, each one processing the
+        entries whose id modulo workers is worker.
+        '''
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        Guarantee = pool.get('guarantee.guarantee')
+        SaleLine = pool.get('sale.line')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        def create_guarantees(line_ids):
+            cursor.execute('SAVEPOINT guarantee_queue')
+            try:
+                SaleLine.create_guarantees(SaleLine.browse(line_ids))
+            except (UserError, DatabaseIntegrityError):
+                Guarantee._rollback_savepoint('guarantee_queue')
+                raise
+            cursor.execute('RELEASE SAVEPOINT guarantee_queue')
+
+        chunk_size = Config(1).guarantee_chunk_size or DEFAULT_CHUNK_SIZE
+        last_id = 0
+        while True:
+            cursor.execute(*table.select(table.id, table.sale_line,
+                    table.attempts,
+                    where=(table.state == 'pending') & (table.id > last_id)
+                    & (table.id % workers == worker),
+                    order_by=[table.id.asc], limit=chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            try:
+                create_guarantees([r[1] for r in rows])
+            except (UserError, DatabaseIntegrityError):
+                pass
+            else:
+                cls._dequeue([r[0] for r in rows])
+                cursor.commit()
+                continue
+            for entry_id, line_id, attempts in rows:
+                try:
+                    create_guarantees([line_id])
+                except (UserError, DatabaseIntegrityError) as exception:
+                    attempts = (attempts or 0) + 1
+                    state = ('failed' if attempts >= max_attempts
+                        else 'pending')
+                    error = (getattr(exception, 'message', None)
+                        or unicode(exception))
+                    cursor.execute(*table.update(
+                            columns=[table.state, table.attempts,
+                                table.error],
+                            values=[state, attempts, error],
+                            where=table.id == entry_id))
+                else:
+                    cls._dequeue([entry_id])
+            cursor.commit()
+
+    @classmethod
+    def _dequeue(cls, ids):
+        'Delete the entries of the processed lines'
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.id, sub_ids)))
+
+
+class Sale:
+    __name__ = 'sale.sale'
+    __metaclass__ = PoolMeta
+
+    @classmethod
+    @ModelView.button
+    def process(cls, sales):
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        Queue = pool.get('guarantee.queue')
+        SaleLine = pool.get('sale.line')
+
+        # Guarantees must exist before the invoices are created by the
+        # process to relate them to the invoice lines
+        by_company = {}
+        for sale in sales:
+            if sale.state in GUARANTEE_SALE_STATES:
+                by_company.setdefault(sale.company.id, []).extend(
+                    l for l in sale.lines
+                    if l.type == 'line' and l.product
+                    and l.product.guarantee_type)
+        for company_id, lines in by_company.iteritems():
+            with Transaction().set_context(company=company_id):
+                creation = Config(1).guarantee_creation
+            if creation == 'queue':
+                Queue.enqueue(lines)
+            elif creation == 'process':
+                SaleLine.create_guarantees(lines)
+        super(Sale, cls).process(sales)
+
+    @classmethod
+    def write(cls, *args):
+        SaleLine = Pool().get('sale.line')
+        actions = iter(args)
+        clear = any('sale_date' in values
+            for _, values in zip(actions, actions))
+        super(Sale, cls).write(*args)
+        if clear:
+            SaleLine._line_in_guarantee_cache().clear()
+
+    def _get_invoice_line_sale_line(self, invoice_type):
+        result = super(Sale, self)._get_invoice_line_sale_line(invoice_type)
+        guarantees = dict((l.id, l.guarantee) for l in self.lines)
+        for line_id, invoice_lines in result.iteritems():
+            for invoice_line in invoice_lines:
+                invoice_line.guarantee = guarantees[line_id]
+        return result
+
+    def create_invoice(self, invoice_type):
+        pool = Pool()
+        Guarantee = pool.get('guarantee.guarantee')
+        invoice = super(Sale, self).create_invoice(invoice_type)
+        if invoice:
+            Guarantee.link_invoice_lines(invoice.lines)
+        return invoice
+
+
+class GuaranteeLineMixin(object):
+    'Shared behaviour of the lines that can be in guarantee'
+
+    @classmethod
+    def __setup__(cls):
+        super(GuaranteeLineMixin, cls).__setup__()
+        cls._error_messages.update({
+                'guarantee_nonzero_unit_prices': ('The following lines must '
+                    'have zero unit price as they are on guarantee:\n%s'),
+                })
+
+    def _apply_guarantee(self):
+        'Sets zero unit price if the line is in guarantee and returns it'
+        if self.on_change_with_line_in_guarantee():
+            self.unit_price = 0
+            self.gross_unit_price = 0
+            return True
+        return False
+
+    def _find_guarantee(self, party, date):
+        'Returns the guarantee of party that applies for the line product'
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        Guarantee = pool.get('guarantee.guarantee')
+        if not party or not self.product or not Config(1).find_guarantee:
+            return
+        key = (party, self.product, date)
+        return Guarantee.find_applicable([key])[key]
+
+
+class SaleLine(GuaranteeLineMixin):
     __name__ = 'sale.line'
     __metaclass__ = PoolMeta
 
@@ -183,17 +1378,15 @@ class SaleLine:
                 'invisible': Eval('type') != 'line',
                 },
             depends=['type']),
-        'on_change_with_line_in_guarantee')
+        'get_line_in_guarantee')
 
-    @classmethod
-    def __setup__(cls):
-        super(SaleLine, cls).__setup__()
-        cls._error_messages.update({
-                'guarantee_nonzero_unit_price': ('Line "%s" must have zero '
-                    'unit price as it is on guarantee'),
-                })
+    @staticmethod
+    def _line_in_guarantee_cache():
+        'Returns the cache of line_in_guarantee of the lines'
+        return transaction_cache('sale_line.line_in_guarantee')
 
     @fields.depends('_parent_sale.sale_date', 'guarantee', 'product')
+    @profiled
     def on_change_with_line_in_guarantee(self, name=None):
         pool = Pool()
         Date = pool.get('ir.date')
@@ -204,21 +1397,81 @@ class SaleLine:
             return self.guarantee.applies_for_product(self.product, date)
         return False
 
+    @classmethod
+    @profiled
+    def get_line_in_guarantee(cls, lines, name):
+        pool = Pool()
+        Guarantee = pool.get('guarantee.guarantee')
+        Sale = pool.get('sale.sale')
+        line = cls.__table__()
+        sale = Sale.__table__()
+
+        in_guarantee = set()
+        for sub_ids in grouped_slice([l.id for l in lines]):
+            in_guarantee |= Guarantee._lines_in_guarantee(
+                line.join(sale, 'LEFT', condition=line.sale == sale.id),
+                line, sale.sale_date, reduce_ids(line.id, sub_ids))
+        return dict((l.id, l.id in in_guarantee) for l in lines)
+
+    @classmethod
+    def get_cached_line_in_guarantee(cls, lines):
+        '''Returns a dictionary with line_in_guarantee of each line
+
+        The values are computed once and kept in a bounded cache of the
+        transaction until the lines, their sale or their guarantee are
+        modified.
+        '''
+        cache = cls._line_in_guarantee_cache()
+
+        result = {}
+        missing = []
+        for line in lines:
+            value = cache.get(line.id)
+            if value is not None:
+                record_cache_hit()
+                result[line.id] = value
+            else:
+                missing.append(line)
+        if missing:
+            values = cls.get_line_in_guarantee(missing, 'line_in_guarantee')
+            cache.update(values)
+            result.update(values)
+        return result
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        clear = any(set(values) & set(['guarantee', 'product', 'sale'])
+            for _, values in zip(actions, actions))
+        super(SaleLine, cls).write(*args)
+        if clear:
+            cls._line_in_guarantee_cache().clear()
+
+    @classmethod
+    def delete(cls, lines):
+        super(SaleLine, cls).delete(lines)
+        cls._line_in_guarantee_cache().clear()
+
     @fields.depends(methods=['quantity'])
+    @profiled
     def on_change_guarantee(self):
-        self.on_change_quantity()
+        if not self._apply_guarantee():
+            super(SaleLine, self).on_change_quantity()
 
-    @fields.depends(methods=['quantity'])
+    @fields.depends('_parent_sale.party', methods=['quantity'])
+    @profiled
     def on_change_product(self):
         super(SaleLine, self).on_change_product()
-        self.on_change_guarantee()
+        if not self.guarantee and self.sale:
+            self.guarantee = self._find_guarantee(self.sale.party,
+                self.sale.sale_date)
+        self._apply_guarantee()
 
     @fields.depends('sale', '_parent_sale.sale_date', 'guarantee', 'product')
+    @profiled
     def on_change_quantity(self):
-        super(SaleLine, self).on_change_quantity()
-        if self.on_change_with_line_in_guarantee():
-            self.unit_price = 0
-            self.gross_unit_price = 0
+        if not self._apply_guarantee():
+            super(SaleLine, self).on_change_quantity()
 
     @fields.depends(methods=['line_in_guarantee'])
     def on_change_with_amount(self):
@@ -227,19 +1480,29 @@ class SaleLine:
     @classmethod
     def validate(cls, lines):
         super(SaleLine, cls).validate(lines)
-        for line in lines:
-            line.check_guarantee()
+        cls.check_guarantees(lines)
 
     def check_guarantee(self):
-        if self.line_in_guarantee and self.unit_price != 0.0:
-            self.raise_user_error('guarantee_nonzero_unit_price',
-                self.rec_name)
+        self.check_guarantees([self])
 
-    def get_invoice_line(self, invoice_type):
-        lines = super(SaleLine, self).get_invoice_line(invoice_type)
-        for line in lines:
-            line.guarantee = self.guarantee
-        return lines
+    @classmethod
+    def check_guarantees(cls, lines):
+        'Check that none of the lines in guarantee has a unit price'
+        pool = Pool()
+        Guarantee = pool.get('guarantee.guarantee')
+        Sale = pool.get('sale.sale')
+        line = cls.__table__()
+        sale = Sale.__table__()
+
+        line_ids = set()
+        for sub_ids in grouped_slice([l.id for l in lines]):
+            line_ids |= Guarantee._lines_in_guarantee(
+                line.join(sale, 'LEFT', condition=line.sale == sale.id),
+                line, sale.sale_date,
+                reduce_ids(line.id, sub_ids) & (line.unit_price != 0))
+        if line_ids:
+            cls.raise_user_error('guarantee_nonzero_unit_prices',
+                '\n'.join(l.rec_name for l in cls.browse(sorted(line_ids))))
 
     def get_guarantee(self):
         pool = Pool()
@@ -257,8 +1520,99 @@ class SaleLine:
         guarantee.sale_lines = [self]
         return guarantee
 
+    @classmethod
+    def create_guarantees(cls, lines):
+        '''Create in bulk the guarantees of the lines of confirmed sales that
+        have none yet'''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Guarantee = pool.get('guarantee.guarantee')
+        GuaranteeSaleLine = pool.get('guarantee.guarantee-sale.line')
+        Product = pool.get('product.product')
+        Config = pool.get('guarantee.configuration')
+
+        line_ids = list(set(l.id for l in lines if l.type == 'line'
+                and l.sale.state in GUARANTEE_SALE_STATES))
+        done = set()
+        for sub_ids in grouped_slice(line_ids):
+            done.update(r.sale_line.id for r in GuaranteeSaleLine.search([
+                        ('sale_line', 'in', list(sub_ids)),
+                        ]))
+        lines = cls.browse([i for i in line_ids if i not in done])
+
+        product_ids = list(set(l.product.id for l in lines if l.product))
+        guarantee_types = dict((p.id, p.guarantee_type)
+            for p in Product.browse(product_ids))
+
+        today = Date.today()
+        by_company = {}
+        for line in lines:
+            if not line.product or not guarantee_types[line.product.id]:
+                continue
+            by_company.setdefault(line.sale.company.id, []).append(line)
+
+        guarantees = []
+        for company_id, company_lines in by_company.iteritems():
+            with Transaction().set_context(company=company_id):
+                config = Config(1)
+                chunk_size = config.guarantee_chunk_size or DEFAULT_CHUNK_SIZE
+                grouped = {}
+                for line in company_lines:
+                    guarantee_type = guarantee_types[line.product.id]
+                    start_date = line.sale.sale_date or today
+                    key = (line.sale.party.id, line.product.id,
+                        guarantee_type.id, start_date)
+                    if not config.group_guarantees:
+                        key += (line.id,)
+                    if key not in grouped:
+                        grouped[key] = {
+                            'party': line.sale.party.id,
+                            'document': str(line.product),
+                            'type': guarantee_type.id,
+                            'start_date': start_date,
+                            'end_date': guarantee_type.get_end_date(
+                                start_date),
+                            'sale_lines': [('add', [])],
+                            }
+                    grouped[key]['sale_lines'][0][1].append(line.id)
+                vlist = grouped.values()
+                for i in xrange(0, len(vlist), chunk_size):
+                    guarantees.extend(
+                        Guarantee.create(vlist[i:i + chunk_size]))
+        # Relate the lines already invoiced, as when the guarantees are
+        # created from the queue
+        Guarantee.link_invoice_lines([il
+                for l in lines if l.product and guarantee_types[l.product.id]
+                for il in l.invoice_lines])
+        return guarantees
 
-class InvoiceLine:
+    @classmethod
+    def create_pending_guarantees(cls):
+        'Create the guarantees of the lines of confirmed sales'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Product = pool.get('product.product')
+        GuaranteeSaleLine = pool.get('guarantee.guarantee-sale.line')
+        cursor = Transaction().cursor
+        line = cls.__table__()
+        sale = Sale.__table__()
+        product = Product.__table__()
+        relation = GuaranteeSaleLine.__table__()
+
+        cursor.execute(*line.join(sale,
+                condition=line.sale == sale.id
+                ).join(product, condition=line.product == product.id
+                ).select(line.id,
+                where=(line.type == 'line')
+                & sale.state.in_(GUARANTEE_SALE_STATES)
+                & (product.guarantee_type != None)
+                & ~line.id.in_(relation.select(relation.sale_line))))
+        line_ids = [r[0] for r in cursor.fetchall()]
+        for sub_ids in grouped_slice(line_ids):
+            cls.create_guarantees(cls.browse(list(sub_ids)))
+
+
+class InvoiceLine(GuaranteeLineMixin):
     __name__ = 'account.invoice.line'
     __metaclass__ = PoolMeta
 
@@ -276,24 +1630,22 @@ class InvoiceLine:
                 'invisible': Eval('type') != 'line',
                 },
             depends=['type']),
-        'on_change_with_line_in_guarantee')
-
-    @classmethod
-    def __setup__(cls):
-        super(InvoiceLine, cls).__setup__()
-        cls._error_messages.update({
-                'guarantee_nonzero_unit_price': ('Line "%s" must have zero '
-                    'unit price as it is on guarantee'),
-                })
+        'get_line_in_guarantee')
 
     @fields.depends('_parent_invoice.invoice_date', 'guarantee', 'product',
         'origin')
+    @profiled
     def on_change_with_line_in_guarantee(self, name=None):
         pool = Pool()
         Date = pool.get('ir.date')
         date = Date.today()
         if (self.guarantee and self.origin and
                 hasattr(self.origin, 'line_in_guarantee')):
+            if (self.origin.__name__ == 'sale.line'
+                    and self.origin.id is not None and self.origin.id >= 0):
+                SaleLine = pool.get('sale.line')
+                return SaleLine.get_cached_line_in_guarantee(
+                    [self.origin])[self.origin.id]
             return self.origin.line_in_guarantee
         if self.invoice and self.invoice.invoice_date:
             date = self.invoice.invoice_date
@@ -301,14 +1653,177 @@ class InvoiceLine:
             return self.guarantee.applies_for_product(self.product, date)
         return False
 
+    @classmethod
+    @profiled
+    def get_line_in_guarantee(cls, lines, name):
+        pool = Pool()
+        Guarantee = pool.get('guarantee.guarantee')
+        Invoice = pool.get('account.invoice')
+        line = cls.__table__()
+        invoice = Invoice.__table__()
+
+        result = {}
+        origins = {}
+        line_ids = []
+        for record in lines:
+            result[record.id] = False
+            if (record.guarantee and record.origin
+                    and hasattr(record.origin, 'line_in_guarantee')):
+                origins.setdefault(record.origin.__name__, {})[record.id] = (
+                    record.origin.id)
+            else:
+                line_ids.append(record.id)
+
+        for sub_ids in grouped_slice(line_ids):
+            result.update(dict((i, True)
+                    for i in Guarantee._lines_in_guarantee(
+                        line.join(invoice, 'LEFT',
+                            condition=line.invoice == invoice.id),
+                        line, invoice.invoice_date,
+                        reduce_ids(line.id, sub_ids))))
+        for model, model_origins in origins.iteritems():
+            Origin = pool.get(model)
+            records = Origin.browse(list(set(model_origins.values())))
+            if model == 'sale.line':
+                origin_values = Origin.get_cached_line_in_guarantee(records)
+            else:
+                origin_values = Origin.get_line_in_guarantee(records, name)
+            for line_id, origin_id in model_origins.iteritems():
+                result[line_id] = origin_values[origin_id]
+        return result
+
+    @classmethod
+    def validate(cls, lines):
+        super(InvoiceLine, cls).validate(lines)
+        cls.check_guarantees(lines)
+
+    @classmethod
+    def check_guarantees(cls, lines):
+        'Check that none of the lines in guarantee has a unit price'
+        pool = Pool()
+        Guarantee = pool.get('guarantee.guarantee')
+        Invoice = pool.get('account.invoice')
+        line = cls.__table__()
+        invoice = Invoice.__table__()
+
+        line_ids = set()
+        for sub_ids in grouped_slice([l.id for l in lines]):
+            line_ids |= Guarantee._lines_in_guarantee(
+                line.join(invoice, 'LEFT',
+                    condition=line.invoice == invoice.id),
+                line, invoice.invoice_date,
+                reduce_ids(line.id, sub_ids) & (line.unit_price != 0))
+        if line_ids:
+            cls.raise_user_error('guarantee_nonzero_unit_prices',
+                '\n'.join(l.rec_name for l in cls.browse(sorted(line_ids))))
+
     @fields.depends(methods=['product'])
+    @profiled
     def on_change_guarantee(self):
-        self.on_change_product()
+        if not self._apply_guarantee():
+            super(InvoiceLine, self).on_change_product()
 
-    @fields.depends('invoice', '_parent_invoice.invoice_date', 'guarantee',
-        'origin')
+    @fields.depends('invoice', '_parent_invoice.invoice_date',
+        '_parent_invoice.party', 'guarantee', 'origin')
+    @profiled
     def on_change_product(self):
         super(InvoiceLine, self).on_change_product()
-        if self.on_change_with_line_in_guarantee():
-            self.unit_price = 0
-            self.gross_unit_price = 0
+        if not self.guarantee and self.invoice:
+            self.guarantee = self._find_guarantee(self.invoice.party,
+                self.invoice.invoice_date)
+        self._apply_guarantee()
+
+
+class CreateGuarantees(Wizard):
+    'Create Guarantees'
+    __name__ = 'sale.sale.create_guarantees'
+    start_state = 'create_'
+    create_ = StateTransition()
+
+    def transition_create_(self):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        sales = Sale.browse(Transaction().context['active_ids'])
+        SaleLine.create_guarantees([l for s in sales for l in s.lines])
+        return 'end'
+
+
+class ImportGuaranteesStart(ModelView):
+    'Import Guarantees'
+    __name__ = 'guarantee.import.start'
+    file_ = fields.Binary('File', required=True, help='CSV file with a '
+        'header containing party, product, start_date and optionally type, '
+        'end_date, code and notes columns')
+    chunk_size = fields.Integer('Chunk Size')
+
+
+class ImportGuaranteesResult(ModelView):
+    'Import Guarantees'
+    __name__ = 'guarantee.import.result'
+    created = fields.Integer('Created', readonly=True)
+    errors = fields.Text('Errors', readonly=True)
+
+
+class ImportGuarantees(Wizard):
+    'Import Guarantees'
+    __name__ = 'guarantee.import'
+    start = StateView('guarantee.import.start',
+        'guarantee.import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView('guarantee.import.result',
+        'guarantee.import_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_import_(self):
+        pool = Pool()
+        Guarantee = pool.get('guarantee.guarantee')
+        reader = csv.DictReader(StringIO(str(self.start.file_)))
+        rows = (dict((k, v.decode('utf-8')) for k, v in r.iteritems() if v)
+            for r in reader)
+        self.result.created, errors = Guarantee.import_rows(rows,
+            chunk_size=self.start.chunk_size or None)
+        self.result.errors = '\n'.join(
+            ('%s: %s' % (first, message) if first == last
+                else '%s-%s: %s' % (first, last, message))
+            for first, last, message in errors)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'created': self.result.created,
+            'errors': self.result.errors,
+            }
+
+
+class UpdateEndDatesResult(ModelView):
+    'Update Guarantee End Dates'
+    __name__ = 'guarantee.type.update_end_dates.result'
+    updated = fields.Integer('Updated Guarantees', readonly=True)
+
+
+class UpdateEndDates(Wizard):
+    'Update Guarantee End Dates'
+    __name__ = 'guarantee.type.update_end_dates'
+    start_state = 'update'
+    update = StateTransition()
+    result = StateView('guarantee.type.update_end_dates.result',
+        'guarantee.update_end_dates_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_update(self):
+        pool = Pool()
+        GuaranteeType = pool.get('guarantee.type')
+        types = GuaranteeType.browse(Transaction().context['active_ids'])
+        self.result.updated = GuaranteeType.update_end_dates(types)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'updated': self.result.updated,
+            }
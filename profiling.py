@@ -0,0 +1,60 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import threading
+import time
+from functools import wraps
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['profiled', 'record_cache_hit']
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+
+
+def is_enabled():
+    '''Returns if the profiling is enabled by the guarantee_profile context
+    key or the profile option of the guarantee section of the configuration
+    '''
+    return (Transaction().context.get('guarantee_profile')
+        or config.getboolean('guarantee', 'profile', default=False))
+
+
+def record_cache_hit():
+    'Count a hit on one of the guarantee caches'
+    _local.cache_hits = getattr(_local, 'cache_hits', 0) + 1
+
+
+def profiled(func):
+    '''Log the time, the number of queries and the number of cache hits of
+    each call to func when the profiling is enabled'''
+    @wraps(func)
+    def wrapper(self_or_cls, *args, **kwargs):
+        if not is_enabled():
+            return func(self_or_cls, *args, **kwargs)
+
+        cursor = Transaction().cursor
+        previous = cursor.__dict__.get('execute')
+        execute = cursor.execute
+        queries = [0]
+
+        def counted_execute(*args, **kwargs):
+            queries[0] += 1
+            return execute(*args, **kwargs)
+        cursor.execute = counted_execute
+        cache_hits = getattr(_local, 'cache_hits', 0)
+        start = time.time()
+        try:
+            return func(self_or_cls, *args, **kwargs)
+        finally:
+            duration = time.time() - start
+            if previous is None:
+                del cursor.execute
+            else:
+                cursor.execute = previous
+            logger.info('%s.%s: %.3fms, %s queries, %s cache hits',
+                self_or_cls.__name__, func.__name__, duration * 1000,
+                queries[0], getattr(_local, 'cache_hits', 0) - cache_hits)
+    return wrapper
@@ -0,0 +1,277 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+from decimal import Decimal
+from sql import Cast, Column, Literal, Null
+from sql.aggregate import Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, Extract
+from sql.operators import Exists, Or
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+__all__ = ['GuaranteeStatistics', 'GuaranteeStatisticsCache']
+
+DEFAULT_EXPIRING_DAYS = 30
+# Margin applied to the last refresh timestamp to catch the guarantees
+# written by transactions that were running during the refresh
+REFRESH_OVERLAP = datetime.timedelta(hours=1)
+
+
+def _group_columns(guarantee):
+    'Returns the type, party, year and month columns of guarantee'
+    return [guarantee.type, guarantee.party,
+        Cast(Extract('YEAR', guarantee.end_date), 'INTEGER'),
+        Cast(Extract('MONTH', guarantee.end_date), 'INTEGER')]
+
+
+def _group_where(columns, keys):
+    'Returns the condition matching columns with any of keys'
+    return Or([
+            (columns[0] == type_) & (columns[1] == party)
+            & (columns[2] == year) & (columns[3] == month)
+            for type_, party, year, month in keys])
+
+
+class StatisticsMixin(object):
+    type = fields.Many2One('guarantee.type', 'Type', readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True)
+    year = fields.Integer('Year', readonly=True,
+        help='The year of the end date of the guarantees')
+    month = fields.Integer('Month', readonly=True,
+        help='The month of the end date of the guarantees')
+    pending_count = fields.Integer('Pending', readonly=True)
+    active_count = fields.Integer('Active', readonly=True)
+    expiring_count = fields.Integer('Expiring', readonly=True,
+        help='Active guarantees that end in the next days')
+    expired_count = fields.Integer('Expired', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StatisticsMixin, cls).__setup__()
+        cls._order.insert(0, ('year', 'DESC'))
+        cls._order.insert(1, ('month', 'DESC'))
+
+    @staticmethod
+    def _expiring_days():
+        Config = Pool().get('guarantee.configuration')
+        return Config(1).expiring_days or DEFAULT_EXPIRING_DAYS
+
+    @classmethod
+    def _aggregate_columns(cls, guarantee):
+        '''Returns the columns aggregating the guarantees by type, party, year
+        and month'''
+        Guarantee = Pool().get('guarantee.guarantee')
+        date = Guarantee._get_guarantee_date()
+        expiring_date = date + datetime.timedelta(days=cls._expiring_days())
+        active = (guarantee.start_date <= date) & (guarantee.end_date >= date)
+
+        def count(condition):
+            return Sum(Case((condition, 1), else_=0))
+        type_, party, year, month = _group_columns(guarantee)
+        return [
+            type_.as_('type'),
+            party.as_('party'),
+            year.as_('year'),
+            month.as_('month'),
+            count(guarantee.start_date > date).as_('pending_count'),
+            count(active).as_('active_count'),
+            count(active & (guarantee.end_date <= expiring_date)
+                ).as_('expiring_count'),
+            count(guarantee.end_date < date).as_('expired_count'),
+            ]
+
+
+class GuaranteeStatistics(StatisticsMixin, ModelSQL, ModelView):
+    'Guarantee Statistics'
+    __name__ = 'guarantee.statistics'
+    sale_value = fields.Function(fields.Numeric('Sale Lines Value',
+            digits=(16, 4), help='The list price value of the sale lines '
+            'with zero unit price under the guarantees'), 'get_value')
+    invoice_value = fields.Function(fields.Numeric('Invoice Lines Value',
+            digits=(16, 4), help='The list price value of the invoice lines '
+            'with zero unit price under the guarantees'), 'get_value')
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        Guarantee = pool.get('guarantee.guarantee')
+        StatisticsCache = pool.get('guarantee.statistics.cache')
+
+        if Config(1).statistics_materialized:
+            table = StatisticsCache.__table__()
+            return table.select(*[Column(table, c) for c in [
+                        'id', 'create_uid', 'create_date', 'write_uid',
+                        'write_date', 'type', 'party', 'year', 'month',
+                        'pending_count', 'active_count', 'expiring_count',
+                        'expired_count']])
+
+        guarantee = Guarantee.__table__()
+        return guarantee.select(
+            Min(guarantee.id).as_('id'),
+            Max(guarantee.create_uid).as_('create_uid'),
+            Max(guarantee.create_date).as_('create_date'),
+            Max(guarantee.write_uid).as_('write_uid'),
+            Max(guarantee.write_date).as_('write_date'),
+            *cls._aggregate_columns(guarantee),
+            group_by=_group_columns(guarantee))
+
+    @classmethod
+    def get_value(cls, statistics, names):
+        pool = Pool()
+        Guarantee = pool.get('guarantee.guarantee')
+        InvoiceLine = pool.get('account.invoice.line')
+        Product = pool.get('product.product')
+        SaleLine = pool.get('sale.line')
+        cursor = Transaction().cursor
+        guarantee = Guarantee.__table__()
+        columns = _group_columns(guarantee)
+
+        keys = dict(((s.type.id, s.party.id, s.year, s.month), s.id)
+            for s in statistics)
+        quantities = {}
+        for name, Line in [
+                ('sale_value', SaleLine),
+                ('invoice_value', InvoiceLine),
+                ]:
+            if name not in names:
+                continue
+            line = Line.__table__()
+            for sub_keys in grouped_slice(keys.keys()):
+                cursor.execute(*line.join(guarantee,
+                        condition=line.guarantee == guarantee.id
+                        ).select(*(columns + [line.product,
+                                Sum(line.quantity)]),
+                        where=((line.unit_price == 0)
+                            & (line.product != Null)
+                            & _group_where(columns, list(sub_keys))),
+                        group_by=columns + [line.product]))
+                for row in cursor.fetchall():
+                    key = (name, keys[tuple(row[:4])], row[4])
+                    quantities[key] = quantities.get(key, 0) + row[5]
+
+        products = Product.browse(list(set(k[2] for k in quantities)))
+        prices = dict((p.id, p.list_price or Decimal(0)) for p in products)
+        result = {}
+        for name in names:
+            result[name] = dict((s.id, Decimal(0)) for s in statistics)
+        for (name, statistic_id, product_id), quantity in (
+                quantities.iteritems()):
+            result[name][statistic_id] += (Decimal(str(quantity or 0))
+                * prices[product_id])
+        return result
+
+
+class GuaranteeStatisticsCache(StatisticsMixin, ModelSQL):
+    'Guarantee Statistics Cache'
+    __name__ = 'guarantee.statistics.cache'
+    dirty = fields.Boolean('Dirty', readonly=True,
+        help='Marked when a guarantee leaves the group')
+
+    @classmethod
+    def mark_dirty(cls, guarantee_ids):
+        '''Mark the stored groups of the guarantees to be recomputed on the
+        next refresh
+
+        It must be called before the type, party or end date of the
+        guarantees change or they are deleted as the recomputation of their
+        new group is triggered by their write date only. Nothing is done when
+        the statistics are not materialized.
+        '''
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        Guarantee = pool.get('guarantee.guarantee')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        guarantee = Guarantee.__table__()
+        type_, party, year, month = _group_columns(guarantee)
+
+        if not guarantee_ids or not Config(1).statistics_materialized:
+            return
+        for sub_ids in grouped_slice(guarantee_ids):
+            cursor.execute(*table.update(
+                    columns=[table.dirty],
+                    values=[True],
+                    where=Exists(guarantee.select(Literal(1),
+                            where=reduce_ids(guarantee.id, sub_ids)
+                            & (type_ == table.type)
+                            & (party == table.party)
+                            & (year == table.year)
+                            & (month == table.month)))))
+
+    @classmethod
+    def refresh(cls, full=False):
+        '''Refresh the stored statistics when they are materialized
+
+        Only the groups marked as dirty and the groups with guarantees that
+        have been written or crossed a date boundary since the last refresh
+        are recomputed unless full is set.
+        '''
+        pool = Pool()
+        Config = pool.get('guarantee.configuration')
+        Date = pool.get('ir.date')
+        Guarantee = pool.get('guarantee.guarantee')
+        transaction = Transaction()
+        cursor = transaction.cursor
+        table = cls.__table__()
+        guarantee = Guarantee.__table__()
+        columns = _group_columns(guarantee)
+
+        config = Config(1)
+        if not config.statistics_materialized:
+            return
+        today = Date.today()
+        last_date = config.statistics_date
+        last_timestamp = config.statistics_timestamp
+        with transaction.set_context(gurantee_date=today):
+            insert_columns = [table.create_uid, table.create_date,
+                table.type, table.party, table.year, table.month,
+                table.pending_count, table.active_count,
+                table.expiring_count, table.expired_count]
+            metadata = [Literal(transaction.user), CurrentTimestamp()]
+            if full or not last_date or not last_timestamp:
+                cursor.execute(*table.delete())
+                cursor.execute(*table.insert(insert_columns,
+                        guarantee.select(*(metadata
+                                + cls._aggregate_columns(guarantee)),
+                            group_by=columns)))
+            else:
+                delta = datetime.timedelta(days=cls._expiring_days())
+                cursor.execute(*guarantee.select(*columns,
+                        where=((Coalesce(guarantee.write_date,
+                                    guarantee.create_date)
+                                >= last_timestamp - REFRESH_OVERLAP)
+                            | ((guarantee.start_date > last_date)
+                                & (guarantee.start_date <= today))
+                            | ((guarantee.end_date >= last_date)
+                                & (guarantee.end_date < today))
+                            | ((guarantee.end_date > last_date + delta)
+                                & (guarantee.end_date <= today + delta))),
+                        group_by=columns))
+                keys = set(cursor.fetchall())
+                cursor.execute(*table.select(table.type, table.party,
+                        table.year, table.month,
+                        where=table.dirty == True))
+                keys.update(cursor.fetchall())
+                for sub_keys in grouped_slice(keys):
+                    sub_keys = list(sub_keys)
+                    cursor.execute(*table.delete(
+                            where=_group_where([table.type, table.party,
+                                    table.year, table.month], sub_keys)))
+                    cursor.execute(*table.insert(insert_columns,
+                            guarantee.select(*(metadata
+                                    + cls._aggregate_columns(guarantee)),
+                                where=_group_where(columns, sub_keys),
+                                group_by=columns)))
+        Config.write([config], {
+                'statistics_date': today,
+                })
+        # Use the database time as it is the one of the write dates
+        config_table = Config.__table__()
+        cursor.execute(*config_table.update(
+                columns=[config_table.statistics_timestamp],
+                values=[CurrentTimestamp()]))
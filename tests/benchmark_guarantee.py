@@ -0,0 +1,320 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''Benchmark of the guarantee hot paths
+
+It creates a company, N guarantees, a sale with N guaranteed lines and a sale
+with N lines without guarantee on the test database and prints the wall time
+and the number of queries of each path. Run it with the DB_NAME environment
+variable set as for the tests:
+
+    python -m trytond.modules.guarantee.tests.benchmark_guarantee [--record]
+        [SIZE ...]
+
+Each size is run in its own transaction which is rolled back at the end.
+
+The number of queries of each path and size is compared to the baseline
+stored in benchmark_guarantee.json and the benchmark fails when it is
+exceeded or missing. Run it with --record to store the current numbers as
+the new baseline.
+'''
+import datetime
+import json
+import os
+import sys
+import time
+from decimal import Decimal
+from dateutil.relativedelta import relativedelta
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+SIZES = [100, 1000, 10000]
+BASELINE = os.path.join(os.path.dirname(__file__), 'benchmark_guarantee.json')
+
+
+class QueryCounter(object):
+    'Count the queries executed on the cursor of the transaction'
+
+    def __init__(self):
+        self.cursor = Transaction().cursor
+        self.count = 0
+
+    def __enter__(self):
+        execute = self.cursor.execute
+
+        def counted_execute(*args, **kwargs):
+            self.count += 1
+            return execute(*args, **kwargs)
+        self.cursor.execute = counted_execute
+        return self
+
+    def __exit__(self, type, value, traceback):
+        del self.cursor.execute
+
+
+def measure(counts, name, size, function, *args, **kwargs):
+    '''Run function, print its wall time and number of queries and store
+    the number of queries in counts'''
+    with QueryCounter() as counter:
+        start = time.time()
+        result = function(*args, **kwargs)
+        duration = time.time() - start
+    sys.stdout.write('%-40s %8d %10.3fs %8d queries\n'
+        % (name, size, duration, counter.count))
+    counts[(name, size)] = counter.count
+    return result
+
+
+def load_baseline():
+    'Return the stored number of queries by path and size'
+    if not os.path.exists(BASELINE):
+        return {}
+    with open(BASELINE) as fileobj:
+        return json.load(fileobj)
+
+
+def save_baseline(baseline):
+    with open(BASELINE, 'w') as fileobj:
+        json.dump(baseline, fileobj, indent=4, sort_keys=True)
+        fileobj.write('\n')
+
+
+def create_data(size):
+    'Create the records needed by the benchmark'
+    pool = POOL
+    Account = pool.get('account.account')
+    AccountType = pool.get('account.account.type')
+    Company = pool.get('company.company')
+    Config = pool.get('guarantee.configuration')
+    Currency = pool.get('currency.currency')
+    GuaranteeType = pool.get('guarantee.type')
+    Party = pool.get('party.party')
+    PaymentTerm = pool.get('account.invoice.payment_term')
+    Product = pool.get('product.product')
+    Sequence = pool.get('ir.sequence')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+    User = pool.get('res.user')
+    transaction = Transaction()
+
+    currency, = Currency.create([{
+                'name': 'Euro',
+                'symbol': u'EUR',
+                'code': 'EUR',
+                }])
+    company_party, customer = Party.create([{
+                'name': 'Benchmark Company',
+                }, {
+                'name': 'Benchmark Customer',
+                'addresses': [('create', [{}])],
+                }])
+    company, = Company.create([{
+                'party': company_party.id,
+                'currency': currency.id,
+                }])
+    User.write([User(USER)], {
+            'main_company': company.id,
+            'company': company.id,
+            })
+    with transaction.set_context(company=company.id):
+        sequence, = Sequence.search([
+                ('code', '=', 'guarantee.guarantee'),
+                ])
+        Config.create([{
+                    'guarantee_sequence': sequence.id,
+                    }])
+        account_type, = AccountType.create([{
+                    'name': 'Benchmark',
+                    'company': company.id,
+                    }])
+        revenue, receivable = Account.create([{
+                    'name': 'Revenue',
+                    'code': 'R',
+                    'kind': 'revenue',
+                    'type': account_type.id,
+                    'company': company.id,
+                    }, {
+                    'name': 'Receivable',
+                    'code': 'C',
+                    'kind': 'receivable',
+                    'reconcile': True,
+                    'type': account_type.id,
+                    'company': company.id,
+                    }])
+        Party.write([customer], {
+                'account_receivable': receivable.id,
+                })
+        payment_term, = PaymentTerm.create([{
+                    'name': 'Direct',
+                    'lines': [('create', [{'type': 'remainder'}])],
+                    }])
+        guarantee_type, = GuaranteeType.create([{
+                    'name': 'Benchmark',
+                    'duration': 24,
+                    'includes_goods': True,
+                    }])
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Benchmark Product',
+                    'type': 'goods',
+                    'salable': True,
+                    'sale_uom': unit.id,
+                    'list_price': Decimal(10),
+                    'cost_price': Decimal(5),
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'account_revenue': revenue.id,
+                    }])
+        product, = Product.create([{
+                    'template': template.id,
+                    'guarantee_type': guarantee_type.id,
+                    }])
+    return {
+        'company': company,
+        'currency': currency,
+        'customer': customer,
+        'payment_term': payment_term,
+        'guarantee_type': guarantee_type,
+        'product': product,
+        'unit': unit,
+        }
+
+
+def benchmark(size, counts):
+    'Run the benchmark of each path for size records'
+    pool = POOL
+    Guarantee = pool.get('guarantee.guarantee')
+    Invoice = pool.get('account.invoice')
+    InvoiceLine = pool.get('account.invoice.line')
+    Sale = pool.get('sale.sale')
+    SaleLine = pool.get('sale.line')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        data = create_data(size)
+        customer, product = data['customer'], data['product']
+        today = datetime.date.today()
+        with transaction.set_context(company=data['company'].id):
+            guarantees = measure(counts, 'Guarantee.create', size,
+                Guarantee.create, [{
+                        'party': customer.id,
+                        'document': str(product),
+                        'type': data['guarantee_type'].id,
+                        'start_date': today - relativedelta(days=i % 900),
+                        'end_date': (today - relativedelta(days=i % 900)
+                            + relativedelta(months=24)),
+                        } for i in xrange(size)])
+            ids = [g.id for g in guarantees]
+            measure(counts, 'Guarantee.read in_guarantee', size,
+                Guarantee.read, ids, ['in_guarantee'])
+            measure(counts, 'Guarantee.search in_guarantee', size,
+                Guarantee.search, [('in_guarantee', '=', True)])
+
+            sale, unguaranteed = Sale.create([{
+                        'party': customer.id,
+                        'company': data['company'].id,
+                        'currency': data['currency'].id,
+                        'payment_term': data['payment_term'].id,
+                        'invoice_address': customer.addresses[0].id,
+                        'shipment_address': customer.addresses[0].id,
+                        'sale_date': today,
+                        'invoice_method': 'order',
+                        'shipment_method': 'order',
+                        'state': 'confirmed',
+                        } for _ in xrange(2)])
+            lines = measure(counts, 'SaleLine.create', size,
+                SaleLine.create, [{
+                        'sale': sale.id,
+                        'type': 'line',
+                        'product': product.id,
+                        'description': product.rec_name,
+                        'quantity': 1,
+                        'unit': data['unit'].id,
+                        'unit_price': Decimal(0),
+                        'guarantee': guarantee_id,
+                        } for guarantee_id in ids])
+            line_ids = [l.id for l in lines]
+            measure(counts, 'SaleLine.read line_in_guarantee', size,
+                SaleLine.read, line_ids, ['line_in_guarantee'])
+            measure(counts, 'SaleLine.validate', size, SaleLine.validate,
+                SaleLine.browse(line_ids))
+
+            def on_change_quantity(lines):
+                for line in lines:
+                    line.on_change_quantity()
+            measure(counts, 'SaleLine.on_change_quantity', size,
+                on_change_quantity, SaleLine.browse(line_ids))
+
+            measure(counts, 'Sale.get_invoice_line', size,
+                Sale(sale.id)._get_invoice_line_sale_line, 'out_invoice')
+
+            def get_guarantee(lines):
+                return [l.get_guarantee() for l in lines]
+            measure(counts, 'SaleLine.get_guarantee', size, get_guarantee,
+                SaleLine.browse(line_ids))
+
+            # Lines of a confirmed sale without guarantee yet
+            unguaranteed_lines = SaleLine.create([{
+                        'sale': unguaranteed.id,
+                        'type': 'line',
+                        'product': product.id,
+                        'description': product.rec_name,
+                        'quantity': 1,
+                        'unit': data['unit'].id,
+                        'unit_price': Decimal(10),
+                        } for _ in xrange(size)])
+            guarantees = measure(counts, 'SaleLine.create_guarantees', size,
+                SaleLine.create_guarantees,
+                SaleLine.browse([l.id for l in unguaranteed_lines]))
+            assert len(guarantees) == size
+
+            invoice = Invoice(type='out_invoice', party=customer,
+                company=data['company'], currency=data['currency'],
+                invoice_date=today)
+
+            def on_change_product(guarantee_ids):
+                for guarantee_id in guarantee_ids:
+                    line = InvoiceLine(invoice=invoice, type='line',
+                        product=product, quantity=1, unit=data['unit'],
+                        guarantee=Guarantee(guarantee_id))
+                    line.on_change_product()
+            measure(counts, 'InvoiceLine.on_change_product', size,
+                on_change_product, ids)
+
+        transaction.cursor.rollback()
+
+
+def main(sizes, record=False):
+    '''Run the benchmark for each size and return 1 if the number of
+    queries of a path exceeds its baseline'''
+    trytond.tests.test_tryton.install_module('guarantee')
+    sys.stdout.write('%-40s %8s %11s %16s\n'
+        % ('Path', 'Size', 'Time', 'Queries'))
+    counts = {}
+    for size in sizes:
+        benchmark(size, counts)
+
+    baseline = load_baseline()
+    if record:
+        for (name, size), count in counts.iteritems():
+            baseline.setdefault(name, {})[str(size)] = count
+        save_baseline(baseline)
+        return 0
+    failed = False
+    for (name, size), count in sorted(counts.iteritems()):
+        expected = baseline.get(name, {}).get(str(size))
+        if expected is None:
+            sys.stdout.write('%s with %s records has no baseline\n'
+                % (name, size))
+            failed = True
+        elif count > expected:
+            sys.stdout.write('%s with %s records runs %s queries instead '
+                'of %s\n' % (name, size, count, expected))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    sys.exit(main([int(a) for a in args if a != '--record'] or SIZES,
+            record='--record' in args))
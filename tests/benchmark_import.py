@@ -0,0 +1,81 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''Benchmark of the start up cost of the guarantee module
+
+It prints the wall time of importing the module in a fresh interpreter,
+compared to importing its dependencies only, and the wall time of
+registering its classes. If the DB_NAME environment variable is set as for
+the tests, it also prints the time to initialise the pool of the database:
+
+    python -m trytond.modules.guarantee.tests.benchmark_import [RUNS]
+
+Each import is measured RUNS times and the best time is kept.
+'''
+import os
+import subprocess
+import sys
+import time
+
+RUNS = 10
+
+DEPENDENCIES = ('import trytond.model, trytond.pool, trytond.wizard, '
+    'trytond.cache, trytond.tools, trytond.pyson, sql')
+MODULE = 'import trytond.modules.guarantee'
+TIMER = ('import time; start = time.time(); %s; '
+    'print(time.time() - start)')
+
+
+def measure_import(statement, runs):
+    'Return the best wall time of running statement in a new interpreter'
+    times = []
+    for _ in xrange(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', TIMER % statement])
+        times.append(float(output))
+    return min(times)
+
+
+def measure_register():
+    'Return the wall time of registering the classes of the module'
+    from trytond.pool import Pool
+    from trytond.modules import guarantee
+
+    classes = Pool.classes
+    Pool.classes = dict((k, {}) for k in classes)
+    try:
+        start = time.time()
+        guarantee.register()
+        return time.time() - start
+    finally:
+        Pool.classes = classes
+
+
+def measure_pool_init():
+    'Return the wall time of initialising the pool of the test database'
+    import trytond.tests.test_tryton
+    from trytond.tests.test_tryton import DB_NAME
+    from trytond.pool import Pool
+
+    trytond.tests.test_tryton.install_module('guarantee')
+    pool = Pool(DB_NAME)
+    start = time.time()
+    pool.init()
+    return time.time() - start
+
+
+def main(runs):
+    dependencies = measure_import(DEPENDENCIES, runs)
+    module = measure_import(MODULE, runs)
+    sys.stdout.write('%-40s %10.3fs\n' % ('Import dependencies', dependencies))
+    sys.stdout.write('%-40s %10.3fs\n' % ('Import guarantee', module))
+    sys.stdout.write('%-40s %10.3fs\n'
+        % ('Import guarantee only', module - dependencies))
+    sys.stdout.write('%-40s %10.3fs\n'
+        % ('Register guarantee', measure_register()))
+    if os.environ.get('DB_NAME'):
+        sys.stdout.write('%-40s %10.3fs\n'
+            % ('Initialise pool', measure_pool_init()))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else RUNS)
@@ -1,13 +1,19 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from contextlib import contextmanager
 from decimal import Decimal
+from StringIO import StringIO
+import csv
 import datetime
+import json
+import logging
 from dateutil.relativedelta import relativedelta
 import unittest
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, test_view,\
     test_depends
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 
 from trytond.tests.test_tryton import ModuleTestCase
 from trytond.tests.test_tryton import (doctest_setup, doctest_teardown,
@@ -24,6 +30,15 @@ class TestCase(ModuleTestCase):
         self.guarantee = POOL.get('guarantee.guarantee')
         self.guarantee_config = POOL.get('guarantee.configuration')
         self.guarantee_type = POOL.get('guarantee.type')
+        self.account = POOL.get('account.account')
+        self.account_type = POOL.get('account.account.type')
+        self.invoice = POOL.get('account.invoice')
+        self.invoice_line = POOL.get('account.invoice.line')
+        self.journal = POOL.get('account.journal')
+        self.party = POOL.get('party.party')
+        self.payment_term = POOL.get('account.invoice.payment_term')
+        self.sale = POOL.get('sale.sale')
+        self.sale_line = POOL.get('sale.line')
         self.product = POOL.get('product.product')
         self.sequence = POOL.get('ir.sequence')
         self.template = POOL.get('product.template')
@@ -164,6 +179,1067 @@ class TestCase(ModuleTestCase):
                 self.assertEqual(guarantee.applies_for_product(data['product'],
                         data['test_date']), data['result'])
 
+    def setup_company(self, tx):
+        'Set the user company and its guarantee sequence'
+        company, = self.company.search([
+                ('rec_name', '=', 'Dunder Mifflin'),
+                ])
+        self.user.write([self.user(USER)], {
+            'main_company': company.id,
+            'company': company.id,
+            })
+        sequence, = self.sequence.search([
+                ('code', '=', 'guarantee.guarantee')
+                ])
+        with tx.set_context(company=company.id):
+            self.guarantee_config.create([{
+                        'guarantee_sequence': sequence.id,
+                        }])
+        return company
+
+    def create_product(self, type_='goods', consumable=False,
+            guarantee_type=None, account_revenue=None):
+        u, = self.uom.search([('name', '=', 'Unit')])
+        template, = self.template.create([{
+                    'account_revenue': (account_revenue.id if account_revenue
+                        else None),
+                    'name': 'Test Guarantee Product',
+                    'type': type_,
+                    'consumable': consumable,
+                    'salable': True,
+                    'sale_uom': u.id,
+                    'list_price': Decimal(1),
+                    'cost_price': Decimal(0),
+                    'cost_price_method': 'fixed',
+                    'default_uom': u.id,
+                    }])
+        product, = self.product.create([{
+                    'template': template.id,
+                    'guarantee_type': (guarantee_type.id if guarantee_type
+                        else None),
+                    }])
+        return product
+
+    def setup_sales(self, company):
+        'Create the customer, payment term and accounts of sales and invoices'
+        with Transaction().set_context(company=company.id):
+            account_type, = self.account_type.create([{
+                        'name': 'Test Guarantee',
+                        'company': company.id,
+                        }])
+            revenue, receivable = self.account.create([{
+                        'name': 'Revenue',
+                        'code': 'R',
+                        'kind': 'revenue',
+                        'type': account_type.id,
+                        'company': company.id,
+                        }, {
+                        'name': 'Receivable',
+                        'code': 'C',
+                        'kind': 'receivable',
+                        'reconcile': True,
+                        'type': account_type.id,
+                        'company': company.id,
+                        }])
+            customer, = self.party.create([{
+                        'name': 'Guarantee Customer',
+                        'addresses': [('create', [{}])],
+                        'account_receivable': receivable.id,
+                        }])
+            payment_term, = self.payment_term.create([{
+                        'name': 'Direct',
+                        'lines': [('create', [{'type': 'remainder'}])],
+                        }])
+        journal, = self.journal.search([
+                ('type', '=', 'revenue'),
+                ], limit=1)
+        return {
+            'customer': customer,
+            'payment_term': payment_term,
+            'revenue': revenue,
+            'receivable': receivable,
+            'journal': journal,
+            }
+
+    def create_sale(self, company, data, lines, state='confirmed',
+            sale_date=None):
+        'Create a sale of the customer with the (product, values) lines'
+        u, = self.uom.search([('name', '=', 'Unit')])
+        customer = data['customer']
+        with Transaction().set_context(company=company.id):
+            sale, = self.sale.create([{
+                        'party': customer.id,
+                        'company': company.id,
+                        'currency': company.currency.id,
+                        'payment_term': data['payment_term'].id,
+                        'invoice_address': customer.addresses[0].id,
+                        'shipment_address': customer.addresses[0].id,
+                        'sale_date': sale_date or datetime.date.today(),
+                        'invoice_method': 'order',
+                        'shipment_method': 'order',
+                        'state': state,
+                        'lines': [('create', [dict({
+                                            'type': 'line',
+                                            'product': product.id,
+                                            'description': product.rec_name,
+                                            'quantity': 1,
+                                            'unit': u.id,
+                                            'unit_price': Decimal(10),
+                                            }, **values)
+                                    for product, values in lines])],
+                        }])
+        return sale
+
+    def create_invoice(self, company, data, lines, invoice_date=None):
+        'Create an invoice of the customer with the (product, values) lines'
+        u, = self.uom.search([('name', '=', 'Unit')])
+        customer = data['customer']
+        with Transaction().set_context(company=company.id):
+            invoice, = self.invoice.create([{
+                        'type': 'out_invoice',
+                        'party': customer.id,
+                        'company': company.id,
+                        'currency': company.currency.id,
+                        'journal': data['journal'].id,
+                        'account': data['receivable'].id,
+                        'payment_term': data['payment_term'].id,
+                        'invoice_address': customer.addresses[0].id,
+                        'invoice_date': invoice_date or datetime.date.today(),
+                        'lines': [('create', [dict({
+                                            'type': 'line',
+                                            'product': product.id,
+                                            'description': product.rec_name,
+                                            'quantity': 1,
+                                            'unit': u.id,
+                                            'unit_price': Decimal(10),
+                                            'account': data['revenue'].id,
+                                            }, **values)
+                                    for product, values in lines])],
+                        }])
+        return invoice
+
+    @contextmanager
+    def no_commit(self, tx):
+        'Count the commits of the transaction instead of doing them'
+        commits = []
+        tx.cursor.commit = lambda: commits.append(True)
+        try:
+            yield commits
+        finally:
+            del tx.cursor.commit
+
+    def test0020_search_in_guarantee(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            today = datetime.date.today()
+            product = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                current, expired, future = self.guarantee.create([{
+                            'party': company.party.id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today - relativedelta(months=1),
+                            'end_date': today + relativedelta(months=1),
+                            }, {
+                            'party': company.party.id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today - relativedelta(months=2),
+                            'end_date': today - relativedelta(months=1),
+                            }, {
+                            'party': company.party.id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today + relativedelta(months=1),
+                            'end_date': today + relativedelta(months=2),
+                            }])
+            codes = [g.code for g in [current, expired, future]]
+            self.assertEqual(len(set(codes)), 3)
+            self.assertEqual([int(c) for c in codes],
+                range(int(codes[0]), int(codes[0]) + 3))
+            self.assertEqual(self.guarantee.search([
+                        ('in_guarantee', '=', True),
+                        ]), [current])
+            self.assertEqual(sorted(self.guarantee.search([
+                            ('in_guarantee', '=', False),
+                            ])), sorted([expired, future]))
+            self.assertEqual(self.guarantee.search([
+                        ('in_guarantee', 'in', [True]),
+                        ]), [current])
+            self.assertEqual(sorted(self.guarantee.search([
+                            ('in_guarantee', 'not in', [True]),
+                            ])), sorted([expired, future]))
+            self.assertEqual(self.guarantee.search([
+                        ('in_guarantee', 'in', []),
+                        ]), [])
+            self.assertEqual(len(self.guarantee.search([
+                            ('in_guarantee', 'in', [True, False]),
+                            ])), 3)
+            self.assertEqual(
+                [g.in_guarantee for g in [current, expired, future]],
+                [True, False, False])
+            self.assertEqual(
+                [g.state for g in [current, expired, future]],
+                ['active', 'expired', 'pending'])
+            with tx.set_context(gurantee_date=today - relativedelta(
+                        months=1, days=15)):
+                self.assertEqual(self.guarantee.search([
+                            ('in_guarantee', '=', True),
+                            ]), [expired])
+
+    def test0030_find_applicable(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            today = datetime.date.today()
+            good = self.create_product()
+            service = self.create_product(type_='service')
+            other = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                old, new, service_guarantee = self.guarantee.create([{
+                            'party': company.party.id,
+                            'document': str(good),
+                            'type': guarantee_type.id,
+                            'start_date': today - relativedelta(months=3),
+                            'end_date': today + relativedelta(months=1),
+                            }, {
+                            'party': company.party.id,
+                            'document': str(good),
+                            'type': guarantee_type.id,
+                            'start_date': today - relativedelta(months=1),
+                            'end_date': today + relativedelta(months=3),
+                            }, {
+                            'party': company.party.id,
+                            'document': str(service),
+                            'type': guarantee_type.id,
+                            'start_date': today,
+                            'end_date': today + relativedelta(months=3),
+                            }])
+            party = company.party
+            keys = [
+                (party, good, today),
+                (party, good, today - relativedelta(months=2)),
+                (party, good, today + relativedelta(months=4)),
+                (party, service, today),
+                (party, other, today),
+                ]
+            result = self.guarantee.find_applicable(keys)
+            self.assertEqual([result[k] for k in keys],
+                [new, old, None, None, None])
+
+    def test0040_update_end_dates(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            product = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'duration': 1,
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                guarantee, = self.guarantee.create([{
+                            'party': company.party.id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': datetime.date(2015, 1, 31),
+                            'end_date': datetime.date(2015, 1, 31),
+                            }])
+            self.assertEqual(
+                self.guarantee_type.update_end_dates([guarantee_type]), 1)
+            guarantee = self.guarantee(guarantee.id)
+            self.assertEqual(guarantee.end_date, datetime.date(2015, 2, 28))
+            self.assertEqual(guarantee.state, 'expired')
+            self.assertEqual(
+                self.guarantee_type.update_end_dates([guarantee_type]), 0)
+
+    def test0050_claims(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            today = datetime.date.today()
+            product = self.create_product()
+            service = self.create_product(type_='service')
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                claimed, unclaimed = self.guarantee.create([{
+                            'party': data['customer'].id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today - relativedelta(months=1),
+                            'end_date': today + relativedelta(months=1),
+                            } for _ in range(2)])
+            self.assertEqual(unclaimed.claim_count, 0)
+            self.assertEqual(unclaimed.last_claim_date, None)
+            self.assertEqual(unclaimed.claim_value, Decimal(0))
+
+            in_guarantee = {
+                'guarantee': claimed.id,
+                'unit_price': Decimal(0),
+                'quantity': 2,
+                }
+            sale = self.create_sale(company, data, [
+                    (product, in_guarantee),
+                    ], sale_date=today - relativedelta(days=10))
+            sale_line, = sale.lines
+            # Invoiced from the sale line so it is not a new claim
+            self.create_invoice(company, data, [
+                    (product, dict(in_guarantee, origin=str(sale_line))),
+                    ], invoice_date=today - relativedelta(days=5))
+            self.create_invoice(company, data, [
+                    (product, dict(in_guarantee, quantity=3)),
+                    # Out of guarantee as the type does not include services
+                    (service, {
+                            'guarantee': claimed.id,
+                            'unit_price': Decimal(10),
+                            }),
+                    ], invoice_date=today - relativedelta(days=2))
+
+            claimed = self.guarantee(claimed.id)
+            self.assertEqual(claimed.claim_count, 3)
+            self.assertEqual(claimed.last_claim_date,
+                today - relativedelta(days=2))
+            # Only the lines with zero unit price at the list price of 1
+            self.assertEqual(claimed.claim_value, Decimal(5))
+            self.assertEqual(self.guarantee.search([
+                        ('claim_count', '=', 0),
+                        ]), [unclaimed])
+            self.assertEqual(self.guarantee.search([
+                        ('claim_count', '>', 0),
+                        ]), [claimed])
+            self.assertEqual(self.guarantee.search([
+                        ('claim_count', '>', 3),
+                        ]), [])
+
+    def test0060_create_guarantees(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'duration': 12,
+                        'includes_goods': True,
+                        }])
+            product = self.create_product(guarantee_type=guarantee_type)
+            other = self.create_product(guarantee_type=guarantee_type)
+            no_guarantee = self.create_product()
+            sale_date = datetime.date(2015, 1, 31)
+            confirmed = self.create_sale(company, data, [
+                    (product, {}),
+                    (product, {}),
+                    (no_guarantee, {}),
+                    ], sale_date=sale_date)
+            draft = self.create_sale(company, data, [(product, {})],
+                state='draft')
+            lines = list(confirmed.lines) + list(draft.lines)
+
+            with tx.set_context(company=company.id):
+                guarantees = self.sale_line.create_guarantees(lines)
+            self.assertEqual(len(guarantees), 2)
+            for guarantee in guarantees:
+                self.assertEqual(guarantee.party, data['customer'])
+                self.assertEqual(guarantee.product, product)
+                self.assertEqual(guarantee.start_date, sale_date)
+                self.assertEqual(guarantee.end_date,
+                    datetime.date(2016, 1, 31))
+                self.assertEqual(len(guarantee.sale_lines), 1)
+            self.assertEqual(
+                sorted(g.sale_lines[0] for g in guarantees),
+                sorted(confirmed.lines[:2]))
+            with tx.set_context(company=company.id):
+                self.assertEqual(self.sale_line.create_guarantees(lines), [])
+
+            with tx.set_context(company=company.id):
+                self.guarantee_config.write([self.guarantee_config(1)], {
+                        'group_guarantees': True,
+                        'guarantee_chunk_size': 1,
+                        })
+            grouped = self.create_sale(company, data, [
+                    (product, {}),
+                    (product, {}),
+                    (other, {}),
+                    ])
+            with tx.set_context(company=company.id):
+                guarantees = self.sale_line.create_guarantees(grouped.lines)
+            self.assertEqual(len(guarantees), 2)
+            self.assertEqual(sorted(len(g.sale_lines) for g in guarantees),
+                [1, 2])
+            self.assertEqual(set(g.product for g in guarantees),
+                set([product, other]))
+
+    def test0070_invoice_line_origin(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            today = datetime.date.today()
+            product = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                guarantee, = self.guarantee.create([{
+                            'party': data['customer'].id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today - relativedelta(months=2),
+                            'end_date': today - relativedelta(months=1),
+                            }])
+            values = {
+                'guarantee': guarantee.id,
+                'unit_price': Decimal(0),
+                }
+            invoice = self.create_invoice(company, data, [(product, values)],
+                invoice_date=today - relativedelta(days=45))
+            origin, = invoice.lines
+            credit = self.create_invoice(company, data, [
+                    (product, dict(values, origin=str(origin))),
+                    (product, values),
+                    ])
+            from_origin, own = credit.lines
+            self.assertEqual(
+                [l.line_in_guarantee for l in [origin, from_origin, own]],
+                [True, True, False])
+            self.assertEqual(
+                [l.on_change_with_line_in_guarantee()
+                    for l in [origin, from_origin, own]],
+                [True, True, False])
+
+    def test0080_check_guarantees(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            today = datetime.date.today()
+            product = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                current, expired = self.guarantee.create([{
+                            'party': data['customer'].id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today - relativedelta(months=1),
+                            'end_date': today + relativedelta(months=1),
+                            }, {
+                            'party': data['customer'].id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today - relativedelta(months=2),
+                            'end_date': today - relativedelta(months=1),
+                            }])
+
+            for create in (self.create_sale, self.create_invoice):
+                create(company, data, [
+                        (product, {
+                                'guarantee': current.id,
+                                'unit_price': Decimal(0),
+                                }),
+                        (product, {
+                                'guarantee': expired.id,
+                                'unit_price': Decimal(10),
+                                }),
+                        (product, {}),
+                        ])
+                with self.assertRaises(UserError) as cm:
+                    create(company, data, [
+                            (product, {
+                                    'guarantee': current.id,
+                                    'unit_price': Decimal(10),
+                                    }),
+                            ])
+                self.assertIn('zero unit price', cm.exception.message)
+
+    def test0090_expire(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            today = datetime.date.today()
+            product = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                guarantee, = self.guarantee.create([{
+                            'party': company.party.id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today,
+                            'end_date': today + relativedelta(months=1),
+                            }])
+            self.assertEqual(guarantee.state, 'active')
+            self.guarantee.expire([guarantee])
+            self.assertEqual(self.guarantee(guarantee.id).state, 'expired')
+
+    def test0095_process_expired(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            today = datetime.date.today()
+            yesterday = today - relativedelta(days=1)
+            product = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                active, started, ended1, ended2, before = (
+                    self.guarantee.create([{
+                                'party': company.party.id,
+                                'document': str(product),
+                                'type': guarantee_type.id,
+                                'start_date': today - relativedelta(months=2),
+                                'end_date': end_date,
+                                } for end_date in [
+                                today + relativedelta(months=1),
+                                today,
+                                yesterday,
+                                today - relativedelta(days=2),
+                                today - relativedelta(days=10),
+                                ]]))
+            # Simulate the dates crossed since the last run
+            self.guarantee.write([started], {'state': 'pending'})
+            self.guarantee.write([ended1, ended2, before], {
+                    'state': 'active',
+                    })
+            self.guarantee_config.write([self.guarantee_config(1)], {
+                    'guarantee_chunk_size': 1,
+                    'expired_date': today - relativedelta(days=5),
+                    })
+
+            with self.no_commit(tx) as commits:
+                self.guarantee.process_expired()
+            # Activation, one per chunk of expired guarantees and the date
+            self.assertEqual(len(commits), 4)
+            self.assertEqual([self.guarantee(g.id).state
+                    for g in [active, started, ended1, ended2, before]],
+                ['active', 'active', 'expired', 'expired', 'active'])
+            self.assertEqual(self.guarantee_config(1).expired_date, yesterday)
+
+            with self.no_commit(tx) as commits:
+                self.guarantee.process_expired()
+            self.assertEqual(len(commits), 2)
+
+    def test0100_export(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            today = datetime.date.today()
+            product = self.create_product()
+            self.product.write([product], {'code': 'P1'})
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                guarantees = self.guarantee.create([{
+                            'party': company.party.id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today,
+                            'end_date': today + relativedelta(months=1),
+                            } for _ in range(3)])
+
+            expected = sorted(g.id for g in guarantees)
+            for page_size in (1, 2, 10):
+                rows = list(self.guarantee.export_rows(page_size=page_size))
+                self.assertEqual([r['id'] for r in rows], expected)
+            row = rows[0]
+            self.assertEqual(row['party'], company.party.name)
+            self.assertEqual(row['type'], 'Goods')
+            self.assertEqual(row['product_code'], 'P1')
+            self.assertEqual(row['product_name'], 'Test Guarantee Product')
+            self.assertEqual(row['start_date'], today)
+            self.assertEqual(row['in_guarantee'], True)
+            self.assertEqual(row['state'], 'active')
+
+            fileobj = StringIO()
+            self.guarantee.export(fileobj, 'csv', page_size=2)
+            fileobj.seek(0)
+            csv_rows = list(csv.DictReader(fileobj))
+            self.assertEqual([int(r['id']) for r in csv_rows], expected)
+            self.assertEqual(csv_rows[0]['product_code'], 'P1')
+            self.assertEqual(csv_rows[0]['start_date'], today.isoformat())
+
+            fileobj = StringIO()
+            self.guarantee.export(fileobj, 'json', page_size=2)
+            json_rows = [json.loads(l)
+                for l in fileobj.getvalue().splitlines()]
+            self.assertEqual([r['id'] for r in json_rows], expected)
+            self.assertEqual(json_rows[0]['product_name'],
+                'Test Guarantee Product')
+            self.assertEqual(json_rows[0]['end_date'],
+                (today + relativedelta(months=1)).isoformat())
+
+    def test0110_import(self):
+        pool = POOL
+        ImportGuarantees = pool.get('guarantee.import', type='wizard')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            party = company.party
+            goods, other = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'duration': 1,
+                        'includes_goods': True,
+                        }, {
+                        'name': 'Other',
+                        'duration': 24,
+                        'includes_goods': True,
+                        }])
+            product = self.create_product(guarantee_type=goods)
+            self.product.write([product], {'code': 'P1'})
+            rows = [{
+                    'party': party.code,
+                    'product': 'P1',
+                    'start_date': '2015-01-31',
+                    }, {
+                    'party': 'unknown',
+                    'product': 'P1',
+                    'start_date': '2015-01-31',
+                    }, {
+                    'party': party.code,
+                    'product': 'unknown',
+                    'start_date': '2015-01-31',
+                    }, {
+                    'party': party.code,
+                    'product': 'P1',
+                    'type': 'unknown',
+                    'start_date': '2015-01-31',
+                    }, {
+                    'party': party.code,
+                    'product': 'P1',
+                    'type': 'Other',
+                    'start_date': '2015-01-31',
+                    }, {
+                    'party': party.code,
+                    'product': 'P1',
+                    'start_date': '2015-01-31',
+                    'end_date': '2015-06-30',
+                    }]
+            with tx.set_context(company=company.id):
+                created, errors = self.guarantee.import_rows(rows,
+                    chunk_size=2)
+            self.assertEqual(created, 3)
+            self.assertEqual([e[:2] for e in errors], [(2, 2), (3, 3), (4, 4)])
+            guarantees = self.guarantee.search([], order=[('id', 'ASC')])
+            self.assertEqual([(g.type, g.end_date) for g in guarantees], [
+                    (goods, datetime.date(2015, 2, 28)),
+                    (other, datetime.date(2017, 1, 31)),
+                    (goods, datetime.date(2015, 6, 30)),
+                    ])
+            self.assertEqual(set(g.product for g in guarantees),
+                set([product]))
+
+            # Without sequence every chunk fails and is reported
+            with tx.set_context(company=company.id):
+                self.guarantee_config.write([self.guarantee_config(1)], {
+                        'guarantee_sequence': None,
+                        })
+                created, errors = self.guarantee.import_rows(
+                    [rows[0]] * 3, chunk_size=2)
+            self.assertEqual(created, 0)
+            self.assertEqual([e[:2] for e in errors], [(1, 2), (3, 3)])
+            self.assertEqual(len(self.guarantee.search([])), 3)
+
+            sequence, = self.sequence.search([
+                    ('code', '=', 'guarantee.guarantee')
+                    ])
+            with tx.set_context(company=company.id):
+                self.guarantee_config.write([self.guarantee_config(1)], {
+                        'guarantee_sequence': sequence.id,
+                        })
+                session_id, _, _ = ImportGuarantees.create()
+                wizard = ImportGuarantees(session_id)
+                wizard.start.file_ = buffer('party,product,start_date\n'
+                    '%s,P1,2015-01-31\nunknown,P1,2015-01-31\n' % party.code)
+                wizard.start.chunk_size = None
+                self.assertEqual(wizard.transition_import_(), 'result')
+            self.assertEqual(wizard.result.created, 1)
+            self.assertEqual(wizard.result.errors, '2: Unknown party "unknown"')
+            self.assertEqual(len(self.guarantee.search([])), 4)
+
+    def test0120_statistics_refresh(self):
+        pool = POOL
+        Statistics = pool.get('guarantee.statistics')
+        StatisticsCache = pool.get('guarantee.statistics.cache')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            today = datetime.date.today()
+            product = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'duration': 1,
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                guarantee, = self.guarantee.create([{
+                            'party': company.party.id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today,
+                            'end_date': today + relativedelta(months=1),
+                            }])
+                self.guarantee_config.write([self.guarantee_config(1)], {
+                        'statistics_materialized': True,
+                        })
+
+            def groups():
+                return sorted((s.year, s.month, s.active_count)
+                    for s in Statistics.search([]))
+
+            def group(date):
+                return (date.year, date.month, 1)
+
+            StatisticsCache.refresh()
+            self.assertEqual(groups(),
+                [group(today + relativedelta(months=1))])
+
+            self.guarantee.write([guarantee], {
+                    'end_date': today + relativedelta(months=3),
+                    })
+            StatisticsCache.refresh()
+            self.assertEqual(groups(),
+                [group(today + relativedelta(months=3))])
+
+            self.guarantee_type.write([guarantee_type], {'duration': 2})
+            self.guarantee_type.update_end_dates([guarantee_type])
+            StatisticsCache.refresh()
+            self.assertEqual(groups(),
+                [group(today + relativedelta(months=2))])
+
+            self.guarantee.delete([guarantee])
+            StatisticsCache.refresh()
+            self.assertEqual(groups(), [])
+
+    def test0130_process_sale(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Services',
+                        'duration': 12,
+                        'includes_services': True,
+                        }])
+            with tx.set_context(company=company.id):
+                product = self.create_product(type_='service',
+                    guarantee_type=guarantee_type,
+                    account_revenue=data['revenue'])
+                self.guarantee_config.write([self.guarantee_config(1)], {
+                        'guarantee_creation': 'process',
+                        })
+            sale = self.create_sale(company, data, [(product, {})])
+            with tx.set_context(company=company.id):
+                self.sale.process([sale])
+            sale = self.sale(sale.id)
+            invoice, = sale.invoices
+            guarantee, = self.guarantee.search([])
+            self.assertEqual(list(guarantee.sale_lines), list(sale.lines))
+            self.assertEqual(list(guarantee.invoice_lines),
+                list(invoice.lines))
+
+            # Relating the invoice lines again does not duplicate them
+            self.guarantee.link_invoice_lines(invoice.lines)
+            with self.no_commit(tx):
+                self.guarantee.backfill_invoice_lines()
+            guarantee = self.guarantee(guarantee.id)
+            self.assertEqual(list(guarantee.invoice_lines),
+                list(invoice.lines))
+
+
+    def test0140_process_queue(self):
+        pool = POOL
+        Queue = pool.get('guarantee.queue')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'duration': 12,
+                        'includes_goods': True,
+                        }])
+            product = self.create_product(guarantee_type=guarantee_type)
+            failing = self.create_sale(company, data, [(product, {})])
+            sale = self.create_sale(company, data, [
+                    (product, {}),
+                    (product, {}),
+                    ])
+
+            Queue.enqueue(failing.lines)
+            Queue.enqueue(list(failing.lines) + list(sale.lines))
+            self.assertEqual(len(Queue.search([])), 3)
+
+            # Without sequence the line fails until it is marked as failed
+            with tx.set_context(company=company.id):
+                self.guarantee_config.write([self.guarantee_config(1)], {
+                        'guarantee_sequence': None,
+                        })
+                with self.no_commit(tx) as commits:
+                    Queue.process_queue(max_attempts=2)
+                    Queue.process_queue(max_attempts=2)
+            self.assertEqual(len(commits), 2)
+            self.assertEqual(self.guarantee.search([]), [])
+            self.assertEqual(
+                [(e.state, e.attempts) for e in Queue.search([])],
+                [('failed', 2)] * 3)
+            self.assertIn('guarantee sequence', Queue.search([])[0].error)
+
+            sequence, = self.sequence.search([
+                    ('code', '=', 'guarantee.guarantee')
+                    ])
+            with tx.set_context(company=company.id):
+                self.guarantee_config.write([self.guarantee_config(1)], {
+                        'guarantee_sequence': sequence.id,
+                        'guarantee_chunk_size': 2,
+                        })
+            Queue.write(Queue.search([
+                        ('sale_line.sale', '=', sale.id),
+                        ]), {
+                    'state': 'pending',
+                    'attempts': 0,
+                    })
+            with tx.set_context(company=company.id):
+                with self.no_commit(tx) as commits:
+                    Queue.process_queue()
+            self.assertEqual(len(commits), 1)
+            guarantees = self.guarantee.search([])
+            self.assertEqual(len(guarantees), 2)
+            self.assertEqual(sorted(l for g in guarantees
+                    for l in g.sale_lines), sorted(sale.lines))
+            # The processed entries are deleted
+            entry, = Queue.search([])
+            self.assertEqual(entry.sale_line, failing.lines[0])
+
+            # Queuing and processing the lines again creates nothing
+            Queue.enqueue(sale.lines)
+            with tx.set_context(company=company.id):
+                with self.no_commit(tx):
+                    Queue.process_queue()
+            self.assertEqual(len(self.guarantee.search([])), 2)
+            self.assertEqual(Queue.search([]), [entry])
+
+
+    def test0150_invoice_line_guarantee(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            today = datetime.date.today()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Services',
+                        'includes_services': True,
+                        }])
+            with tx.set_context(company=company.id):
+                product = self.create_product(type_='service',
+                    account_revenue=data['revenue'])
+                guarantee, = self.guarantee.create([{
+                            'party': data['customer'].id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today,
+                            'end_date': today + relativedelta(months=1),
+                            }])
+            sale = self.create_sale(company, data, [
+                    (product, {
+                            'guarantee': guarantee.id,
+                            'unit_price': Decimal(0),
+                            }),
+                    (product, {}),
+                    ])
+            with tx.set_context(company=company.id):
+                result = sale._get_invoice_line_sale_line('out_invoice')
+            in_guarantee, other = sale.lines
+            self.assertEqual(
+                [l.guarantee for l in result[in_guarantee.id]], [guarantee])
+            self.assertEqual(
+                [l.guarantee for l in result[other.id]], [None])
+
+
+    def test0160_archive_expired(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            today = datetime.date.today()
+            product = self.create_product()
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                recent, old = self.guarantee.create([{
+                            'party': data['customer'].id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': end_date - relativedelta(years=1),
+                            'end_date': end_date,
+                            } for end_date in [
+                            today - relativedelta(months=2),
+                            today - relativedelta(months=7),
+                            ]])
+            sale = self.create_sale(company, data, [
+                    (product, {'guarantee': old.id}),
+                    ])
+            invoice = self.create_invoice(company, data, [
+                    (product, {'guarantee': old.id}),
+                    ])
+            self.guarantee.write([old], {
+                    'sale_lines': [('add', [l.id for l in sale.lines])],
+                    })
+
+            with self.no_commit(tx) as commits:
+                self.guarantee.archive_expired()
+            self.assertEqual(commits, [])
+            self.assertEqual(len(self.guarantee.search([])), 2)
+
+            self.guarantee_config.write([self.guarantee_config(1)], {
+                    'archive_months': 6,
+                    })
+            with self.no_commit(tx) as commits:
+                self.guarantee.archive_expired()
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(self.guarantee.search([]), [recent])
+            self.assertEqual(self.guarantee.search([
+                        ('party', '=', data['customer'].id),
+                        ]), [recent])
+            with tx.set_context(active_test=False):
+                self.assertEqual(sorted(self.guarantee.search([])),
+                    sorted([recent, old]))
+            old = self.guarantee(old.id)
+            self.assertEqual(old.active, False)
+            self.assertEqual(list(old.sale_lines), list(sale.lines))
+            sale_line, = self.sale_line.browse([l.id for l in sale.lines])
+            self.assertEqual(sale_line.guarantee, old)
+            self.assertEqual(sale_line.guarantee.end_date,
+                today - relativedelta(months=7))
+            invoice_line, = self.invoice_line.browse(
+                [l.id for l in invoice.lines])
+            self.assertEqual(invoice_line.guarantee, old)
+            self.assertEqual(invoice_line.guarantee.end_date,
+                today - relativedelta(months=7))
+
+
+    def test0170_profiling(self):
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = Handler()
+        logger = logging.getLogger('trytond.modules.guarantee.profiling')
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+                company = self.setup_company(tx)
+                today = datetime.date.today()
+                product = self.create_product()
+                guarantee_type, = self.guarantee_type.create([{
+                            'name': 'Goods',
+                            'includes_goods': True,
+                            }])
+                with tx.set_context(company=company.id):
+                    guarantee, = self.guarantee.create([{
+                                'party': company.party.id,
+                                'document': str(product),
+                                'type': guarantee_type.id,
+                                'start_date': today,
+                                'end_date': today + relativedelta(months=1),
+                                }])
+                key = (company.party, product, today)
+
+                self.assertEqual(self.guarantee.find_applicable([key]),
+                    {key: guarantee})
+                self.assertEqual(records, [])
+                self.assertNotIn('execute', tx.cursor.__dict__)
+
+                self.guarantee.clear_cache()
+                with tx.set_context(guarantee_profile=True):
+                    for _ in range(2):
+                        self.assertEqual(
+                            self.guarantee.find_applicable([key]),
+                            {key: guarantee})
+                    self.guarantee.get_claims([guarantee], ['claim_count'])
+                self.assertNotIn('execute', tx.cursor.__dict__)
+                self.assertEqual([r.args[:2] for r in records], [
+                        ('guarantee.guarantee', 'find_applicable'),
+                        ('guarantee.guarantee', 'find_applicable'),
+                        ('guarantee.guarantee', 'get_claims'),
+                        ])
+                first, second, claims = [r.args[3:] for r in records]
+                # The second call reads the guarantee values from the cache
+                self.assertGreater(first[0], second[0])
+                self.assertGreater(second[1], first[1])
+                self.assertGreater(claims[0], 0)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+
+    def test0180_on_change(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as tx:
+            company = self.setup_company(tx)
+            data = self.setup_sales(company)
+            today = datetime.date.today()
+            u, = self.uom.search([('name', '=', 'Unit')])
+            guarantee_type, = self.guarantee_type.create([{
+                        'name': 'Goods',
+                        'includes_goods': True,
+                        }])
+            with tx.set_context(company=company.id):
+                product = self.create_product(
+                    account_revenue=data['revenue'])
+                guarantee, = self.guarantee.create([{
+                            'party': data['customer'].id,
+                            'document': str(product),
+                            'type': guarantee_type.id,
+                            'start_date': today,
+                            'end_date': today + relativedelta(months=1),
+                            }])
+            sale = self.create_sale(company, data, [])
+            invoice = self.invoice(type='out_invoice',
+                party=data['customer'], company=company,
+                currency=company.currency, invoice_date=today)
+
+            def count_evaluations(line):
+                'Returns the list of the evaluations of the guarantee'
+                evaluations = []
+                method = line.on_change_with_line_in_guarantee
+
+                def on_change_with_line_in_guarantee(name=None):
+                    evaluations.append(True)
+                    return method(name)
+                line.on_change_with_line_in_guarantee = (
+                    on_change_with_line_in_guarantee)
+                return evaluations
+
+            for Line, parent, method in [
+                    (self.sale_line, {'sale': sale}, 'on_change_quantity'),
+                    (self.sale_line, {'sale': sale}, 'on_change_guarantee'),
+                    (self.invoice_line, {'invoice': invoice},
+                        'on_change_guarantee'),
+                    ]:
+                # The price is zeroed in guarantee and computed by the
+                # upstream on_change otherwise
+                for line_guarantee, unit_price in [
+                        (guarantee, Decimal(0)),
+                        (None, product.list_price),
+                        ]:
+                    line = Line(type='line', product=product, quantity=1,
+                        unit=u, unit_price=Decimal(10),
+                        guarantee=line_guarantee, **parent)
+                    evaluations = count_evaluations(line)
+                    with tx.set_context(company=company.id):
+                        getattr(line, method)()
+                    self.assertEqual(line.unit_price, unit_price)
+                    self.assertEqual(len(evaluations), 1)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()